@@ -0,0 +1,226 @@
+# benchmark_faces.py - Face pipeline micro-benchmarks
+#
+# Times decode, detect, encode and match separately on the sample photos in
+# uploads/ and on synthetic classroom collages built from them, then writes the
+# percentiles and peak memory to JSON so runs from different commits can be compared.
+# Runs offline on CPU; no database is needed.
+#
+#   python benchmark_faces.py --faces 10,30 --resolutions 1920x1080,4000x3000 --output before.json
+#   python benchmark_faces.py --output after.json --compare before.json
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+import smth
+from smth import app
+
+UPLOADS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def load_sample_photos(directory):
+    """Encoded bytes of every sample photo, keyed by file name"""
+    photos = {}
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in PHOTO_EXTENSIONS:
+            with open(os.path.join(directory, name), 'rb') as f:
+                photos[name] = f.read()
+    return photos
+
+def build_collage(photos, face_count, width, height, quality=90):
+    """JPEG of `face_count` sample portraits laid out in a grid, like a classroom photo"""
+    columns = max(1, round(np.sqrt(face_count * width / height)))
+    rows = -(-face_count // columns)
+    cell_w, cell_h = width // columns, height // rows
+
+    portraits = [Image.open(io.BytesIO(data)).convert('RGB') for data in photos.values()]
+    collage = Image.new('RGB', (width, height), (128, 128, 128))
+    for i in range(face_count):
+        portrait = portraits[i % len(portraits)].copy()
+        portrait.thumbnail((cell_w, cell_h))
+        x = (i % columns) * cell_w + (cell_w - portrait.width) // 2
+        y = (i // columns) * cell_h + (cell_h - portrait.height) // 2
+        collage.paste(portrait, (x, y))
+
+    buffer = io.BytesIO()
+    collage.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def build_gallery(enrollment_encodings, roster_size, seed=0):
+    """Class gallery of the enrolled sample faces padded with random students up to roster_size"""
+    rng = np.random.default_rng(seed)
+    encodings = [np.asarray(e, dtype=np.float32) for e in enrollment_encodings]
+    while len(encodings) < roster_size:
+        encodings.append(rng.normal(0, 0.1, smth.FACE_ENCODING_DIM).astype(np.float32))
+    ids = list(range(1, len(encodings) + 1))
+    return {
+        'ids': ids,
+        'names': [f"Student {i}" for i in ids],
+        'student_ids': [f"BENCH{i:05d}" for i in ids],
+        'encodings': np.vstack(encodings).reshape(-1, smth.FACE_ENCODING_DIM),
+        'roster': [{'id': i, 'name': f"Student {i}", 'student_id': f"BENCH{i:05d}"} for i in ids]
+    }
+
+def measure(stage_fn, repeat, warmup=1):
+    """Wall-clock samples in milliseconds, then the Python-heap peak of one extra run"""
+    for _ in range(warmup):
+        stage_fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        stage_fn()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    stage_fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'runs': repeat,
+        'mean_ms': round(float(np.mean(samples)), 3),
+        'min_ms': round(float(np.min(samples)), 3),
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p90_ms': round(float(np.percentile(samples, 90)), 3),
+        'p99_ms': round(float(np.percentile(samples, 99)), 3),
+        'max_ms': round(float(np.max(samples)), 3),
+        'peak_python_mb': round(peak / (1024 * 1024), 3)
+    }
+
+def benchmark_photo(scenario, image_bytes, expected_faces, gallery, repeat):
+    """Time each capture stage on one photo; stage inputs are computed once up front"""
+    image_array = smth.open_image_array(image_bytes)
+    face_locations, detector_path = smth.detect_faces(image_array, expected_faces)
+    kept_locations, face_encodings, rejected = smth.encode_face_regions(image_array, face_locations)
+
+    stages = {
+        'decode': lambda: smth.open_image_array(image_bytes),
+        'detect': lambda: smth.detect_faces(image_array, expected_faces),
+        'encode': lambda: smth.encode_face_regions(image_array, face_locations),
+        'match': lambda: smth.match_faces_to_students(face_encodings, 'bench', 0, gallery=gallery),
+        'process_class_photo': lambda: smth.process_class_photo(image_bytes, expected_faces)
+    }
+    info = {
+        'height': image_array.shape[0], 'width': image_array.shape[1], 'bytes': len(image_bytes),
+        'faces_detected': len(face_locations), 'faces_encoded': len(face_encodings),
+        'faces_rejected': len(rejected), 'detector_path': detector_path
+    }
+
+    results = []
+    for stage, stage_fn in stages.items():
+        result = {'scenario': scenario, 'stage': stage, **info, **measure(stage_fn, repeat)}
+        print(f"{scenario:>28} {stage:>20}: p50 {result['p50_ms']:.1f} ms", flush=True)
+        results.append(result)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def compare(results, baseline_path):
+    """Print the p50 change of every (scenario, stage) also present in a baseline file"""
+    with open(baseline_path) as f:
+        baseline = {(r['scenario'], r['stage']): r for r in json.load(f)['results']}
+    print(f"\n{'scenario':>28} {'stage':>20} {'base p50':>10} {'p50':>10} {'change':>8}")
+    for result in results:
+        before = baseline.get((result['scenario'], result['stage']))
+        if before is None:
+            continue
+        change = (result['p50_ms'] / before['p50_ms'] - 1) * 100 if before['p50_ms'] else 0.0
+        print(f"{result['scenario']:>28} {result['stage']:>20} {before['p50_ms']:>10.1f} {result['p50_ms']:>10.1f} {change:>+7.1f}%")
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def run_benchmarks(args, photos):
+    """Enrollment encodes, then every stage on a portrait and on each collage"""
+    with app.app_context():
+        results = []
+        enrollment_encodings = []
+        for name, data in photos.items():
+            encoding = smth.encode_face_from_base64(data)
+            if encoding is not None:
+                enrollment_encodings.append(encoding)
+            result = {'scenario': f"enroll-{name}", 'stage': 'encode_face_from_base64', 'bytes': len(data),
+                      **measure(lambda: smth.encode_face_from_base64(data), args.repeat)}
+            results.append(result)
+        gallery = build_gallery(enrollment_encodings, args.roster_size)
+
+        first_name, first_photo = next(iter(photos.items()))
+        results.extend(benchmark_photo(f"portrait-{first_name}", first_photo, 1, gallery, args.repeat))
+        for resolution in args.resolutions.split(','):
+            width, height = parse_resolution(resolution)
+            for face_count in (int(n) for n in args.faces.split(',')):
+                collage = build_collage(photos, face_count, width, height)
+                results.extend(benchmark_photo(f"collage-{face_count}-{width}x{height}", collage,
+                                               face_count, gallery, args.repeat))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the face detection, encoding and matching pipeline')
+    parser.add_argument('--uploads', default=UPLOADS_DIR, help='Directory of sample portraits')
+    parser.add_argument('--faces', default='10,30', help='Comma-separated face counts of the synthetic collages')
+    parser.add_argument('--resolutions', default='1920x1080,4000x3000', help='Comma-separated collage sizes, WxH')
+    parser.add_argument('--roster-size', type=int, default=40, help='Students in the class gallery used for matching')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per stage')
+    parser.add_argument('--pool-workers', type=int, default=0,
+                        help='Processes in a face pool started for the run; 0 runs detection and encoding in this process')
+    parser.add_argument('--no-escalation', action='store_true', help='Disable the slow detector cascade')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', help='Earlier results file to print p50 changes against')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    app.config['FACE_POOL_WORKERS'] = args.pool_workers
+    app.config['FACE_POOL_ADDRESS'] = os.path.join(tempfile.mkdtemp(), 'face-pool.sock') if args.pool_workers else None
+    app.config['PHOTO_CACHE_MAX_ENTRIES'] = 0  # every run must do the full work
+    if args.no_escalation:
+        app.config['FACE_DETECTION_ESCALATION_MODEL'] = None
+
+    photos = load_sample_photos(args.uploads)
+    if not photos:
+        parser.error(f"No sample photos found in {args.uploads}")
+
+    pool_process = smth.start_face_pool_server()
+    try:
+        results = run_benchmarks(args, photos)
+    finally:
+        if pool_process is not None:
+            pool_process.terminate()
+            pool_process.wait()
+
+    report = {
+        'meta': {
+            'commit': git_commit(), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'cpu_count': os.cpu_count(), 'repeat': args.repeat, 'roster_size': args.roster_size,
+            'pool_workers': args.pool_workers, 'escalation': not args.no_escalation,
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
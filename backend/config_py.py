@@ -15,7 +15,53 @@ class Config:
     
     # Face recognition settings
     FACE_RECOGNITION_TOLERANCE = 0.6
-    FACE_DETECTION_MODEL = 'hog'  # or 'cnn' for better accuracy but slower
+    FACE_DETECTION_MODEL = 'hog'  # fast first-pass detector; 'cnn' is more accurate but far slower on CPU
+    FACE_DETECTION_ESCALATION_MODEL = 'cnn'  # run when the fast pass misses faces; None disables the cascade
+    FACE_DETECTION_ESCALATION_RATIO = 0.7  # escalate below this fraction of the faces expected from the roster
+    FACE_DETECTION_ESCALATION_UPSAMPLE = 0
+    FACE_DETECTION_MAX_SIDE = 2000  # longest side of the working image used for detection
+    FACE_DETECTION_MIN_FACE_RATIO = 0.02  # smallest expected face (back rows) as a fraction of the long side
+    FACE_DETECTION_MIN_FACE_PX = 80  # smallest face HOG finds without upsampling
+    FACE_DETECTION_MAX_UPSAMPLE = 1  # upsampling passes allowed when faces fall below that size
+    FACE_DETECTION_UPSAMPLE_BAND = 0.6  # top fraction of the photo (back rows) that is upsampled; 1.0 upsamples all of it
+    FACE_DETECTION_TILING = True  # split large working images into tiles detected in parallel
+    FACE_DETECTION_TILE_SIZE = 800  # tile side in working-image pixels
+    FACE_DETECTION_TILE_OVERLAP = 200  # minimum shared pixels between tiles
+    FACE_DETECTION_MAX_FACE_RATIO = 0.15  # largest expected face (front rows) as a fraction of the long side; sets the overlap
+    FACE_DETECTION_TILE_NMS_THRESHOLD = 0.5  # overlap (of the smaller box) above which seam duplicates merge
+    FACE_ENCODE_MIN_FACE_PX = 80  # JPEGs are decoded at reduced scale while the smallest face stays above this; keep well above FACE_QUALITY_MIN_FACE_PX
+    FACE_CROP_MARGIN = 0.5  # padding around each box, as a fraction of its size, for encoding
+    FACE_QUALITY_GATE = True  # skip encoding faces that are too small, blurry or turned away
+    FACE_QUALITY_MIN_FACE_PX = 40  # shortest box side in the decoded image
+    FACE_QUALITY_MIN_SHARPNESS = 20.0  # Laplacian variance of the face resampled to 64px
+    FACE_QUALITY_MAX_YAW = 0.5  # nose offset from the eye midpoint, in inter-eye distances
+    FACE_POOL_ADDRESS = os.environ.get('FACE_POOL_ADDRESS')  # Unix socket path or host:port of the shared face pool; unset runs face work in-process
+    FACE_POOL_AUTHKEY = os.environ.get('FACE_POOL_AUTHKEY')  # defaults to SECRET_KEY
+    FACE_POOL_WORKERS = os.cpu_count() or 1  # processes in the shared face pool, for all web workers together
+    FACE_WORKER_PREWARM = True  # run a dummy inference in each worker when the pool starts
+    FACE_WORKER_TIMEOUT = 120  # seconds to wait for a detect/encode call
+    BULK_ENROLL_MAX_RECORDS = 200  # students per bulk enrollment request; also bounded by MAX_CONTENT_LENGTH
+    BULK_ENROLL_CHUNK_SIZE = 32  # enrollment photos decoded and held in memory at once
+    CAPTURE_MAX_IMAGES = 5  # photos accepted in one capture session
+    CAPTURE_JOB_WORKERS = 2  # threads running asynchronous capture jobs per web process
+    CAPTURE_JOB_HEARTBEAT = 30  # seconds between a web process's liveness updates on the captures it owns
+    CAPTURE_JOB_STALE_AFTER = 300  # captures without a heartbeat for this long are failed as orphaned
+    PHOTO_CACHE_TTL = 15 * 60  # seconds a photo's detected faces are reused for resubmissions
+    PHOTO_CACHE_MAX_ENTRIES = 256  # 0 disables the cache
+    FACE_MATCH_ASSIGNMENT = 'greedy'  # or 'optimal' to use each student at most once per photo
+    FACE_TEMPLATES_MAX = 10  # face templates kept per student; the oldest capture template is replaced
+    FACE_TEMPLATE_MIN_CONFIDENCE = 0.6  # confirmed matches at least this confident become templates
+    FACE_MATCH_CANDIDATES = 3  # runner-up students returned per face for manual correction
+    FACE_INDEX_SUGGESTIONS = True  # look unmatched faces up in the other classes of the school
+    FACE_INDEX_SCOPE = 'school'  # or 'district' to also search the other schools of the district
+    FACE_INDEX_MIN_TRAIN = 1024  # below this many encodings the index is one exact list
+    FACE_DUPLICATE_TOLERANCE = 0.4  # enrollments closer than this to an enrolled face are refused
+    FACE_INDEX_NPROBE = 8  # nearest partitions scored per lookup
+    FACE_INDEX_CACHE_MAX_SCHOOLS = 16  # school indexes kept per process; district scope keeps the whole district
+    FACE_GALLERY_QUANTIZATION = None  # 'float16' or 'int8' to cache class galleries at 1/2 or ~1/4 the memory
+    FACE_GALLERY_RERANK = 5  # nearest students per face re-scored on exact encodings when quantized
+    FACE_GALLERY_CACHE_MAX_BYTES = 128 * 1024 * 1024  # per-process class gallery cache
+    FACE_GALLERY_DIR = os.environ.get('FACE_GALLERY_DIR')  # shared gallery files from `flask export-galleries`
     
     # SMS settings (for future integration)
     # In config.py, inside the Config class
@@ -0,0 +1,35 @@
+# gunicorn_conf.py - Gunicorn settings for the attendance backend
+#
+# The arbiter starts the shared face worker pool once, before any web worker is
+# forked, and stops it on shutdown; web workers only connect to it.
+#
+#   gunicorn -c gunicorn_conf.py smth:app
+import os
+import tempfile
+
+# Config reads this when smth is imported, in the arbiter and in every web worker
+os.environ.setdefault('FACE_POOL_ADDRESS', os.path.join(tempfile.gettempdir(), 'attendance-face-pool.sock'))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 180  # above FACE_WORKER_TIMEOUT, so a slow face call fails before the worker is killed
+
+_face_pool_process = None
+
+def when_ready(server):
+    global _face_pool_process
+    import smth
+
+    with smth.app.app_context():
+        smth.fail_orphaned_capture_jobs()
+        # Forked web workers must not share the arbiter's database connections
+        smth.db.engine.dispose()
+    _face_pool_process = smth.start_face_pool_server()
+    if _face_pool_process is not None:
+        server.log.info(f"Face worker pool started (pid {_face_pool_process.pid})")
+
+def on_exit(server):
+    if _face_pool_process is not None:
+        _face_pool_process.terminate()
+        _face_pool_process.wait()
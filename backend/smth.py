@@ -6,22 +6,41 @@ from flask import current_app
 from flask_jwt_extended import JWTManager
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from sqlalchemy import func
+from sqlalchemy import func, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
 from twilio.rest import Client
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-import face_recognition
 import cv2
 import numpy as np
+from scipy.optimize import linear_sum_assignment
 from PIL import Image
 import base64
 import io
 import os
+import math
+import time
+import hashlib
 import json
+import csv
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 import logging
 from functools import wraps
 import uuid
+import click
+import mmap
+import struct
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.managers import BaseManager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Initialize Flask app
 from config_py import config
@@ -109,13 +128,33 @@ class Student(db.Model):
     guardian_name = db.Column(db.String(100), nullable=False)
     guardian_phone = db.Column(db.String(15), nullable=False)
     health_notes = db.Column(db.Text)
-    face_encoding = db.Column(db.Text)  # JSON encoded face features
+    face_encoding = db.Column(db.Text)  # Legacy JSON encoded face features, see migrate-face-encodings
+    face_encoding_bin = db.Column(db.LargeBinary)  # 128 float32 values (512 bytes), centroid of the face templates
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     school = db.relationship('School', backref='students')
 
+class StudentFaceTemplate(db.Model):
+    __tablename__ = 'student_face_templates'
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False, index=True)
+    encoding = db.Column(db.LargeBinary, nullable=False)  # 128 float32 values (512 bytes)
+    source = db.Column(db.String(20), nullable=False, default='enrollment')  # enrollment, capture
+    session_id = db.Column(db.String(36))  # capture session the template was taken from
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class GalleryVersion(db.Model):
+    __tablename__ = 'gallery_versions'
+    id = db.Column(db.Integer, primary_key=True)
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), nullable=False)
+    class_name = db.Column(db.String(20), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)  # bumped on every roster change
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.UniqueConstraint('school_id', 'class_name', name='uq_gallery_version_class'),)
+
 class TeacherAssignment(db.Model):
     __tablename__ = 'teacher_assignments'
     id = db.Column(db.Integer, primary_key=True)
@@ -140,12 +179,39 @@ class PhotoUpload(db.Model):
     processing_status = db.Column(db.String(20), default='pending')  # pending, processing, completed, failed
     detected_faces_count = db.Column(db.Integer, default=0)
     recognition_results = db.Column(db.Text)  # JSON encoded results
+    face_encodings = db.Column(db.LargeBinary)  # float32 encodings of every encoded face, in face_index order
+    face_boxes = db.Column(db.LargeBinary)  # int32 (photo_index, top, right, bottom, left) per face, same order
+    worker_id = db.Column(db.String(80))  # host:pid of the web process running the capture
+    heartbeat_at = db.Column(db.DateTime)  # last liveness update from that process
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
     uploader = db.relationship('User', backref='photo_uploads')
     school = db.relationship('School', backref='photo_uploads')
 
+class CaptureTiming(db.Model):
+    __tablename__ = 'capture_timings'
+    id = db.Column(db.Integer, primary_key=True)
+    photo_upload_id = db.Column(db.Integer, db.ForeignKey('photo_uploads.id'), unique=True, nullable=False)
+    school_id = db.Column(db.Integer, db.ForeignKey('schools.id'), nullable=False, index=True)
+    # Stage durations in milliseconds; per-photo stages are summed over the photos of the session
+    queue_ms = db.Column(db.Float)  # asynchronous captures only: wait before a job thread picked it up
+    gallery_ms = db.Column(db.Float)
+    decode_ms = db.Column(db.Float)
+    detect_ms = db.Column(db.Float)
+    encode_ms = db.Column(db.Float)
+    match_ms = db.Column(db.Float)
+    commit_ms = db.Column(db.Float)
+    total_ms = db.Column(db.Float)
+    image_width = db.Column(db.Integer)  # largest photo of the session, as decoded
+    image_height = db.Column(db.Integer)
+    total_photos = db.Column(db.Integer)
+    face_count = db.Column(db.Integer)
+    detector_path = db.Column(db.String(50))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    photo_upload = db.relationship('PhotoUpload', backref=db.backref('timing', uselist=False))
+
 class AttendanceRecord(db.Model):
     __tablename__ = 'attendance_records'
     id = db.Column(db.Integer, primary_key=True)
@@ -241,8 +307,12 @@ def require_school_access(f):
         # For GET requests, use request.args instead of request.json
         if request.method == 'GET':
             school_id = request.args.get('school_id')
+        elif request.is_json:
+            school_id = (request.get_json(silent=True) or {}).get('school_id')
+        elif request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+            school_id = request.form.get('school_id')
         else:
-            school_id = request.json.get('school_id') if request.json else None
+            school_id = request.args.get('school_id')
         
         if user.role == 'district':
             if school_id:
@@ -256,120 +326,1473 @@ def require_school_access(f):
         return f(user, *args, **kwargs)
     return decorated_function
 
-# --- Utility Functions ---
-def encode_face_from_base64(image_data):
-    """Convert base64 image to face encoding"""
+# --- Face Worker Pool ---
+# Detection and encoding run in one pool of long-lived processes that load the dlib
+# models once and warm them up at start. The pool lives in its own server process,
+# started once at boot (gunicorn_conf.when_ready, `flask serve-face-pool` or
+# __main__), and every web worker reaches it through a multiprocessing manager at
+# FACE_POOL_ADDRESS; the web tier only decodes and crops images. Without an address
+# face work runs inline in the web process. face_recognition loads every dlib model
+# when imported, so only the _face_worker_* functions import it: web workers that
+# use the pool never hold a copy of the models.
+_face_pool = None
+_face_pool_lock = threading.Lock()
+_face_pool_service = None
+
+def _face_worker_init():
+    """Exercise the detector, landmark and encoder models once so real requests skip the warm-up"""
+    import face_recognition
+    dummy = np.zeros((160, 160, 3), dtype=np.uint8)
+    face_recognition.face_locations(dummy)
+    face_recognition.face_encodings(dummy, [(10, 150, 150, 10)])
+
+def _face_worker_ping(_=None):
+    return os.getpid()
+
+def _face_worker_detect(working, upsample, model):
+    import face_recognition
+    return face_recognition.face_locations(working, number_of_times_to_upsample=upsample, model=model)
+
+def face_yaw(shape):
+    """Horizontal nose offset from the eye midpoint in inter-eye distances; 0 is frontal"""
+    points = [(shape.part(i).x, shape.part(i).y) for i in range(5)]
+    eye_a = ((points[0][0] + points[1][0]) / 2, (points[0][1] + points[1][1]) / 2)
+    eye_b = ((points[2][0] + points[3][0]) / 2, (points[2][1] + points[3][1]) / 2)
+    eye_distance = math.hypot(eye_a[0] - eye_b[0], eye_a[1] - eye_b[1])
+    return abs(points[4][0] - (eye_a[0] + eye_b[0]) / 2) / max(eye_distance, 1.0)
+
+def _face_worker_encode(crops, locations, max_yaw=None):
+    """Encode many faces with one batched call into the dlib ResNet.
+
+    Same pipeline as face_recognition.face_encodings (5-point landmarks, 150px chips
+    with 0.25 padding, no jitter), but every aligned chip is extracted first and the
+    descriptors are computed in one batch. Faces turned further than max_yaw are not
+    encoded; they come back as None. Returns the encodings and the yaw of every face.
+    """
+    import dlib
+    import face_recognition
+
+    chips, yaws, keep = [], [], []
+    for crop, (top, right, bottom, left) in zip(crops, locations):
+        shape = face_recognition.api.pose_predictor_5_point(crop, dlib.rectangle(left, top, right, bottom))
+        yaw = face_yaw(shape)
+        yaws.append(yaw)
+        keep.append(max_yaw is None or yaw <= max_yaw)
+        if keep[-1]:
+            chips.append(dlib.get_face_chip(crop, shape, size=150, padding=0.25))
+
+    descriptors = face_recognition.api.face_encoder.compute_face_descriptor(chips) if chips else []
+    descriptors = iter([np.array(d) for d in descriptors])
+    return [next(descriptors) if kept else None for kept in keep], yaws
+
+def _face_worker_encode_image(image_array):
+    import face_recognition
+    face_encodings = face_recognition.face_encodings(image_array)
+    return face_encodings[0] if face_encodings else None
+
+# Clients name the function to run: under `python smth.py` the functions pickle as
+# __main__.*, which the pool server (running under the flask CLI) cannot resolve
+FACE_WORKER_FUNCTIONS = {
+    func.__name__: func
+    for func in (_face_worker_ping, _face_worker_detect, _face_worker_encode, _face_worker_encode_image)
+}
+
+class FaceWorkerService:
+    """The shared worker pool; the manager runs each client call in its own thread"""
+
+    def __init__(self, workers, prewarm=True, timeout=120):
+        self.timeout = timeout
+        # spawn rather than fork: the server process is multi-threaded
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            processes=workers, initializer=_face_worker_init if prewarm else None
+        )
+        # Pool starts every process eagerly; wait until each has run its initializer
+        self.pool.map(_face_worker_ping, range(workers), chunksize=1)
+
+    def call(self, name, args):
+        return self.pool.apply_async(FACE_WORKER_FUNCTIONS[name], args).get(self.timeout)
+
+    def starmap(self, name, args_list):
+        func = FACE_WORKER_FUNCTIONS[name]
+        pending = [self.pool.apply_async(func, args) for args in args_list]
+        return [result.get(self.timeout) for result in pending]
+
+class FacePoolManager(BaseManager):
+    pass
+
+FacePoolManager.register('face_pool', callable=lambda: _face_pool_service)
+
+def face_pool_address():
+    """FACE_POOL_ADDRESS as a listener address: host:port for TCP, anything else is a Unix socket path"""
+    address = app.config.get('FACE_POOL_ADDRESS')
+    if not address:
+        return None
+    host, _, port = address.rpartition(':')
+    return (host or 'localhost', int(port)) if port.isdigit() else address
+
+def face_pool_workers():
+    """Processes in the shared pool; one per core unless FACE_POOL_WORKERS says otherwise"""
+    return app.config.get('FACE_POOL_WORKERS') or os.cpu_count() or 1
+
+def face_pool_manager():
+    authkey = app.config.get('FACE_POOL_AUTHKEY') or app.config['SECRET_KEY']
+    return FacePoolManager(address=face_pool_address(), authkey=authkey.encode())
+
+def serve_face_pool():
+    """Run the shared face worker pool until the process is stopped"""
+    global _face_pool_service
+    address = face_pool_address()
+    if address is None:
+        raise RuntimeError('FACE_POOL_ADDRESS is not configured')
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)  # socket left behind by a server that did not shut down cleanly
+
+    # SIGTERM ends serve_forever() through SystemExit, so the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = face_pool_workers()
+    _face_pool_service = FaceWorkerService(
+        workers, app.config.get('FACE_WORKER_PREWARM', True), app.config.get('FACE_WORKER_TIMEOUT', 120)
+    )
+    try:
+        # The listener only opens once every worker is warm, so clients never wait on a cold pool
+        server = face_pool_manager().get_server()
+        logger.info(f"Face worker pool of {workers} processes listening on {address}")
+        server.serve_forever()
+    finally:
+        _face_pool_service.pool.terminate()
+
+def start_face_pool_server():
+    """Start `flask serve-face-pool` in a child process and wait until it accepts connections.
+
+    Call once at boot, before web workers are forked; a plain subprocess rather than a
+    multiprocessing.Process, so forked workers do not try to join it when they exit.
+    Returns the process, or None when no FACE_POOL_ADDRESS is configured.
+    """
+    if face_pool_address() is None:
+        return None
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'smth', 'serve-face-pool',
+         '--address', app.config['FACE_POOL_ADDRESS'], '--workers', str(face_pool_workers())],
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+
+    deadline = time.monotonic() + app.config.get('FACE_WORKER_TIMEOUT', 120)
+    while True:
+        try:
+            face_pool_manager().connect()
+            return process
+        except (ConnectionError, FileNotFoundError):
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError('Face worker pool failed to start')
+            time.sleep(0.2)
+
+def face_pool():
+    """Proxy of the shared face worker pool for this process, or None to run face work inline"""
+    global _face_pool
+    if face_pool_address() is None:
+        return None
+    with _face_pool_lock:
+        if _face_pool is None:
+            manager = face_pool_manager()
+            manager.connect()
+            _face_pool = manager.face_pool()
+        return _face_pool
+
+def reset_face_pool():
+    """Drop a proxy whose server went away; the next call reconnects"""
+    global _face_pool
+    with _face_pool_lock:
+        _face_pool = None
+
+def face_pool_reachable():
+    """True when a pool server is configured and accepting connections"""
+    try:
+        return face_pool() is not None
+    except (EOFError, OSError):
+        reset_face_pool()
+        return False
+
+def face_worker_call(func, *args):
+    """Run a face computation on the shared pool, or inline when no pool is configured"""
+    pool = face_pool()
+    if pool is None:
+        return func(*args)
     try:
+        return pool.call(func.__name__, args)
+    except (EOFError, ConnectionError):
+        reset_face_pool()
+        raise
+
+def face_worker_starmap(func, args_list):
+    """Run independent face computations across all workers and return results in order"""
+    pool = face_pool()
+    if pool is None:
+        return [func(*args) for args in args_list]
+    try:
+        return pool.starmap(func.__name__, args_list)
+    except (EOFError, ConnectionError):
+        reset_face_pool()
+        raise
+
+@app.cli.command('serve-face-pool')
+@click.option('--address', help='Overrides FACE_POOL_ADDRESS')
+@click.option('--workers', type=int, help='Overrides FACE_POOL_WORKERS')
+def serve_face_pool_command(address, workers):
+    """Run the shared face worker pool in the foreground (e.g. under systemd)"""
+    if address:
+        app.config['FACE_POOL_ADDRESS'] = address
+    if workers:
+        app.config['FACE_POOL_WORKERS'] = workers
+    serve_face_pool()
+
+# --- Utility Functions ---
+def truthy(value):
+    """Boolean flag from JSON (true) or form/query fields ('true', '1')"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def read_upload_request(file_field):
+    """Fields and image sources of an upload request.
+
+    Supports the JSON body with base64 data URLs, multipart/form-data with file
+    parts under `file_field`, and a raw image/* body with the fields in the query
+    string. Binary uploads are returned as streams so PIL reads them directly.
+    """
+    if request.mimetype.startswith('image/'):
+        return request.args.to_dict(), [request.stream]
+    if request.mimetype == 'multipart/form-data':
+        return request.form.to_dict(), [f.stream for f in request.files.getlist(file_field) if f]
+    return request.get_json() or {}, None
+
+EXIF_ORIENTATION = 0x0112
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM, 5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90
+}
+
+def decode_scale(height, width):
+    """Largest reduction that still serves both detection and encoding.
+
+    Detection never looks past its working resolution, and the encoder gains little
+    once the smallest expected face covers FACE_ENCODE_MIN_FACE_PX, so pixels beyond
+    both are never used. That floor sits well above the quality gate's minimum so no
+    face is rejected for the reduction alone; with the defaults 12 MP photos decode
+    at full size and photos from about 8000px on at 1/2.
+    """
+    detect_scale, _ = detection_plan(height, width)
+    smallest_face = app.config.get('FACE_DETECTION_MIN_FACE_RATIO', 0.02) * max(height, width)
+    encode_scale = min(1.0, app.config.get('FACE_ENCODE_MIN_FACE_PX', 80) / smallest_face)
+    return max(detect_scale, encode_scale)
+
+def image_payload_bytes(image_data):
+    """Encoded image bytes from a base64 data URL, a binary stream or bytes"""
+    if isinstance(image_data, str):
         if ',' in image_data:
             image_data = image_data.split(',')[1]
-            
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        image_array = np.array(image)
-        face_encodings = face_recognition.face_encodings(image_array)
-        
-        if len(face_encodings) == 0:
-            return None
-        
-        return face_encodings[0]
+        return base64.b64decode(image_data)
+    if hasattr(image_data, 'read'):
+        return image_data.read()
+    return image_data
+
+def open_image_array(image_data):
+    """Decode a base64 data URL, raw bytes or a binary stream into an RGB array.
+
+    JPEGs are decoded straight to RGB at a reduced DCT scale when decode_scale()
+    allows it and EXIF orientation is applied to the reduced image. np.asarray
+    still copies the pixels once, through Pillow's tobytes(); the array is read-only.
+    """
+    if isinstance(image_data, str):
+        image_data = image_payload_bytes(image_data)
+    if isinstance(image_data, (bytes, bytearray)):
+        image_data = io.BytesIO(image_data)
+
+    image = Image.open(image_data)
+    orientation = image.getexif().get(EXIF_ORIENTATION)
+
+    scale = decode_scale(image.height, image.width)
+    if image.format == 'JPEG':
+        # draft() picks the smallest 1/2, 1/4 or 1/8 scale that is still at least this size
+        image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if orientation in EXIF_TRANSPOSE:
+        image = image.transpose(EXIF_TRANSPOSE[orientation])
+    return np.asarray(image)
+
+def encode_face_from_base64(image_data):
+    """Convert base64 image (or binary upload) to face encoding"""
+    try:
+        image_array = open_image_array(image_data)
+        return face_worker_call(_face_worker_encode_image, image_array)
         
     except Exception as e:
         logger.error(f"Error generating class report: {str(e)}")
         return None
 
-def process_class_photo(image_data):
+def encode_faces_from_images(images):
+    """Face encodings for many enrollment photos, computed in parallel on the worker pool.
+
+    Uses the same decode and encode steps as encode_face_from_base64, a chunk of
+    photos at a time so only one chunk of pixels is held in memory. Entries that
+    fail to decode or show no face come back as None.
+    """
+    chunk_size = app.config.get('BULK_ENROLL_CHUNK_SIZE', 32)
+    encodings = []
+    for start in range(0, len(images), chunk_size):
+        arrays = []
+        for image_data in images[start:start + chunk_size]:
+            try:
+                arrays.append(open_image_array(image_data))
+            except Exception as e:
+                logger.error(f"Error decoding enrollment photo: {str(e)}")
+                arrays.append(None)
+
+        results = iter(face_worker_starmap(_face_worker_encode_image, [(a,) for a in arrays if a is not None]))
+        encodings.extend(next(results) if a is not None else None for a in arrays)
+    return encodings
+
+def detection_plan(height, width):
+    """Working scale and HOG upsample count for an image of the given size.
+
+    The image is shrunk until the smallest face we expect (back rows) sits at the
+    detector's minimum face size, or to FACE_DETECTION_MAX_SIDE if that is smaller,
+    and upsampled back when the smallest faces fall below the minimum. It is never
+    shrunk further than FACE_DETECTION_MAX_UPSAMPLE passes can make up for.
+    """
+    long_side = max(height, width)
+    min_face_px = app.config.get('FACE_DETECTION_MIN_FACE_PX', 80)
+    smallest_face = app.config.get('FACE_DETECTION_MIN_FACE_RATIO', 0.02) * long_side
+    max_upsample = app.config.get('FACE_DETECTION_MAX_UPSAMPLE', 1)
+
+    target_scale = min_face_px / smallest_face
+    scale = min(1.0, target_scale, app.config.get('FACE_DETECTION_MAX_SIDE', 2000) / long_side)
+    scale = max(scale, min(1.0, target_scale / 2 ** max_upsample))
+
+    upsample = 0
+    while smallest_face * scale * (2 ** upsample) < min_face_px and upsample < max_upsample:
+        upsample += 1
+    return scale, upsample
+
+def tile_starts(length, tile, overlap):
+    """Evenly spaced tile offsets covering `length` with at least `overlap` shared pixels"""
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+def merge_face_boxes(boxes, threshold):
+    """Non-maximum suppression for (top, right, bottom, left) boxes from overlapping tiles.
+
+    HOG gives no scores, so larger boxes win: a face cut by a tile edge yields a
+    partial box mostly inside the complete one from the neighbouring tile. Overlap
+    is measured against the smaller box so those partial boxes are dropped too.
+    """
+    if len(boxes) < 2:
+        return list(boxes)
+    b = np.asarray(boxes, dtype=np.float64)
+    top, right, bottom, left = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+    areas = (bottom - top) * (right - left)
+
+    order = np.argsort(-areas)
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        inter_h = np.clip(np.minimum(bottom[i], bottom[rest]) - np.maximum(top[i], top[rest]), 0, None)
+        inter_w = np.clip(np.minimum(right[i], right[rest]) - np.maximum(left[i], left[rest]), 0, None)
+        overlap = inter_h * inter_w / np.minimum(areas[i], areas[rest])
+        order = rest[overlap <= threshold]
+    return [boxes[i] for i in sorted(keep)]
+
+def detect_tiled(working, upsample, model):
+    """Detect faces on overlapping tiles in parallel across the face workers.
+
+    The tile overlap covers the largest expected face (FACE_DETECTION_MAX_FACE_RATIO
+    of the long side) so every face is complete in at least one tile; duplicates on
+    the seams are merged afterwards. Small images, a pool of one, or faces too large
+    for the tile size are detected in a single call.
+    """
+    height, width = working.shape[:2]
+    tile = app.config.get('FACE_DETECTION_TILE_SIZE', 800)
+    overlap = max(
+        app.config.get('FACE_DETECTION_TILE_OVERLAP', 200),
+        math.ceil(app.config.get('FACE_DETECTION_MAX_FACE_RATIO', 0.15) * max(height, width))
+    )
+    workers = face_pool_workers() if face_pool() is not None else 1
+
+    if (not app.config.get('FACE_DETECTION_TILING', True) or workers < 2
+            or max(height, width) <= tile or overlap * 2 > tile):
+        return face_worker_call(_face_worker_detect, working, upsample, model)
+
+    offsets = [(y, x) for y in tile_starts(height, tile, overlap) for x in tile_starts(width, tile, overlap)]
+    tile_locations = face_worker_starmap(_face_worker_detect, [
+        (np.ascontiguousarray(working[y:y + tile, x:x + tile]), upsample, model) for y, x in offsets
+    ])
+
+    boxes = [
+        (top + y, right + x, bottom + y, left + x)
+        for (y, x), locations in zip(offsets, tile_locations)
+        for top, right, bottom, left in locations
+    ]
+    merged = merge_face_boxes(boxes, app.config.get('FACE_DETECTION_TILE_NMS_THRESHOLD', 0.5))
+    logger.debug(f"Tiled detection: {len(offsets)} tiles, {len(boxes)} boxes merged into {len(merged)}")
+    return merged
+
+def detect_banded(working, upsample, model):
+    """Detect without upsampling everywhere, and upsampled only across the back rows.
+
+    Faces at or above the detector's minimum size are found in a pass at the working
+    size. The pass that upsamples for the smallest faces covers only the top
+    FACE_DETECTION_UPSAMPLE_BAND of the photo, where the back rows sit, extended by
+    one minimum face so faces on its lower edge are not cut.
+    """
+    band = app.config.get('FACE_DETECTION_UPSAMPLE_BAND', 0.6)
+    if upsample == 0 or band >= 1.0:
+        return detect_tiled(working, upsample, model)
+
+    height = working.shape[0]
+    band_rows = min(height, math.ceil(height * band) + app.config.get('FACE_DETECTION_MIN_FACE_PX', 80))
+    locations = detect_tiled(working, 0, model)
+    locations += detect_tiled(np.ascontiguousarray(working[:band_rows]), upsample, model)
+    return merge_face_boxes(locations, app.config.get('FACE_DETECTION_TILE_NMS_THRESHOLD', 0.5))
+
+def detect_faces(image_array, expected_faces=None):
+    """Run face detection on a downsampled working copy and map boxes back to full resolution.
+
+    The fast detector always runs first. When the class roster says more faces should
+    be in the photo than it found (below FACE_DETECTION_ESCALATION_RATIO of
+    expected_faces), the slower escalation detector also runs and its boxes are merged
+    in. Returns the boxes and the detector path taken, e.g. 'hog' or 'hog+cnn'.
+    """
+    height, width = image_array.shape[:2]
+    scale, upsample = detection_plan(height, width)
+
+    working = image_array
+    if scale < 1.0:
+        working = cv2.resize(
+            image_array, (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+
+    logger.debug(f"Detecting on {working.shape[1]}x{working.shape[0]} (scale {scale:.3f}, upsample {upsample})")
+
+    model = app.config.get('FACE_DETECTION_MODEL', 'hog')
+    locations = detect_banded(working, upsample, model)
+    detector_path = model
+
+    escalation_model = app.config.get('FACE_DETECTION_ESCALATION_MODEL')
+    shortfall = expected_faces and len(locations) < expected_faces * app.config.get('FACE_DETECTION_ESCALATION_RATIO', 0.7)
+    if escalation_model and escalation_model != model and shortfall:
+        escalated = detect_tiled(working, app.config.get('FACE_DETECTION_ESCALATION_UPSAMPLE', 0), escalation_model)
+        logger.debug(f"{model} found {len(locations)} of {expected_faces} expected faces, {escalation_model} found {len(escalated)}")
+        locations = merge_face_boxes(locations + escalated, app.config.get('FACE_DETECTION_TILE_NMS_THRESHOLD', 0.5))
+        detector_path = f"{model}+{escalation_model}"
+
+    return [
+        (
+            max(0, int(round(top / scale))), min(width, int(round(right / scale))),
+            min(height, int(round(bottom / scale))), max(0, int(round(left / scale)))
+        )
+        for top, right, bottom, left in locations
+    ], detector_path
+
+def face_sharpness(image_array, location):
+    """Laplacian variance of the face, resampled to 64px so faces of any size compare"""
+    top, right, bottom, left = location
+    gray = cv2.cvtColor(np.ascontiguousarray(image_array[top:bottom, left:right]), cv2.COLOR_RGB2GRAY)
+    gray = cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+def encode_face_regions(image_array, face_locations):
+    """Quality-gate each face, then encode the rest from padded crops around their boxes.
+
+    Faces that are too small or too blurry are rejected here, and extreme profiles in
+    the worker once landmarks are known, so the encoder never runs on crops that
+    cannot match. Returns the kept locations, their encodings and the rejected faces.
+    """
+    height, width = image_array.shape[:2]
+    margin = app.config.get('FACE_CROP_MARGIN', 0.5)
+    gate = app.config.get('FACE_QUALITY_GATE', True)
+    min_size = app.config.get('FACE_QUALITY_MIN_FACE_PX', 40)
+    min_sharpness = app.config.get('FACE_QUALITY_MIN_SHARPNESS', 20.0)
+
+    kept, crops, locations, rejected = [], [], [], []
+    for location in face_locations:
+        top, right, bottom, left = location
+        if gate:
+            size = min(bottom - top, right - left)
+            if size < min_size:
+                rejected.append({'location': list(location), 'reason': 'too_small', 'size': int(size)})
+                continue
+            sharpness = face_sharpness(image_array, location)
+            if sharpness < min_sharpness:
+                rejected.append({'location': list(location), 'reason': 'blurry', 'sharpness': round(sharpness, 1)})
+                continue
+
+        pad_y = int((bottom - top) * margin)
+        pad_x = int((right - left) * margin)
+        y0, y1 = max(0, top - pad_y), min(height, bottom + pad_y)
+        x0, x1 = max(0, left - pad_x), min(width, right + pad_x)
+
+        kept.append(location)
+        crops.append(np.ascontiguousarray(image_array[y0:y1, x0:x1]))
+        locations.append((top - y0, right - x0, bottom - y0, left - x0))
+
+    if not crops:
+        return [], [], rejected
+
+    encodings, yaws = face_worker_call(
+        _face_worker_encode, crops, locations, app.config.get('FACE_QUALITY_MAX_YAW', 0.5) if gate else None
+    )
+
+    face_locations, face_encodings = [], []
+    for location, encoding, yaw in zip(kept, encodings, yaws):
+        if encoding is None:
+            rejected.append({'location': list(location), 'reason': 'pose', 'yaw': round(yaw, 2)})
+            continue
+        face_locations.append(location)
+        face_encodings.append(encoding)
+    return face_locations, face_encodings, rejected
+
+# --- Photo Result Cache ---
+# Teachers on flaky connections resubmit the same photo. Detection and encoding
+# results are kept per process, keyed by a hash of the encoded image bytes and the
+# settings that influence them, so a retry only re-runs the cheap matching step.
+_photo_cache = OrderedDict()
+_photo_cache_lock = threading.Lock()
+
+PHOTO_CACHE_SETTINGS = (
+    'FACE_DETECTION_MODEL', 'FACE_DETECTION_MAX_SIDE', 'FACE_DETECTION_MIN_FACE_RATIO',
+    'FACE_DETECTION_MIN_FACE_PX', 'FACE_DETECTION_MAX_UPSAMPLE', 'FACE_DETECTION_UPSAMPLE_BAND',
+    'FACE_ENCODE_MIN_FACE_PX', 'FACE_CROP_MARGIN', 'FACE_QUALITY_GATE', 'FACE_QUALITY_MIN_FACE_PX', 'FACE_QUALITY_MIN_SHARPNESS',
+    'FACE_QUALITY_MAX_YAW', 'FACE_DETECTION_ESCALATION_MODEL', 'FACE_DETECTION_ESCALATION_RATIO',
+    'FACE_DETECTION_ESCALATION_UPSAMPLE'
+)
+
+def photo_cache_key(image_bytes, expected_faces=None):
+    digest = hashlib.sha256(image_bytes)
+    # The expected face count decides whether the detector cascade escalates
+    digest.update(repr([app.config.get(name) for name in PHOTO_CACHE_SETTINGS] + [expected_faces]).encode())
+    return digest.hexdigest()
+
+def _photo_cache_get(key):
+    with _photo_cache_lock:
+        entry = _photo_cache.get(key)
+        if entry is None:
+            return None
+        if entry['expires_at'] < time.monotonic():
+            del _photo_cache[key]
+            return None
+        _photo_cache.move_to_end(key)
+        return entry['result']
+
+def _photo_cache_put(key, result):
+    max_entries = app.config.get('PHOTO_CACHE_MAX_ENTRIES', 256)
+    if max_entries <= 0:
+        return
+    with _photo_cache_lock:
+        _photo_cache[key] = {
+            'result': result,
+            'expires_at': time.monotonic() + app.config.get('PHOTO_CACHE_TTL', 15 * 60)
+        }
+        _photo_cache.move_to_end(key)
+        while len(_photo_cache) > max_entries:
+            _photo_cache.popitem(last=False)
+
+def process_class_photo(image_data, expected_faces=None):
     """Process class photo and detect all faces"""
     try:
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-            
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        image_array = np.array(image)
+        image_bytes = image_payload_bytes(image_data)
+        cache_key = photo_cache_key(image_bytes, expected_faces)
+        cached = _photo_cache_get(cache_key)
+        if cached is not None:
+            logger.debug(f"Reusing {cached['total_faces']} faces from an earlier submission of this photo")
+            return dict(cached, timings={}, cache_hit=True)
+
+        started = time.perf_counter()
+        image_array = open_image_array(image_bytes)
+        decoded = time.perf_counter()
         
-        face_locations = face_recognition.face_locations(image_array)
+        face_locations, detector_path = detect_faces(image_array, expected_faces)
+        detected = time.perf_counter()
 
         logger.info(f"[DEBUG] Number of faces detected: {len(face_locations)}")  # Added debug log
 
-        face_encodings = face_recognition.face_encodings(image_array, face_locations)
+        face_locations, face_encodings, rejected_faces = encode_face_regions(image_array, face_locations)
+        encoded = time.perf_counter()
 
-        logger.info(f"[DEBUG] Number of face encodings extracted: {len(face_encodings)}")  # Added debug log
+        logger.info(f"[DEBUG] Number of face encodings extracted: {len(face_encodings)}, rejected by quality gate: {len(rejected_faces)}")  # Added debug log
 
         if len(face_encodings) > 0:
             logger.debug(f"[DEBUG] Sample face encoding (first 5 values): {face_encodings[0][:5]}")  # Added debug log
         
-        return {
+        result = {
             'face_locations': face_locations,
             'face_encodings': face_encodings,
-            'total_faces': len(face_locations)
+            'rejected_faces': rejected_faces,
+            'total_faces': len(face_locations) + len(rejected_faces),
+            'detector_path': detector_path,
+            'image_size': list(image_array.shape[:2])
         }
+        _photo_cache_put(cache_key, result)
+        return dict(result, timings={
+            'decode_ms': (decoded - started) * 1000, 'detect_ms': (detected - decoded) * 1000,
+            'encode_ms': (encoded - detected) * 1000
+        })
         
     except Exception as e:
         logger.error(f"Error processing class photo: {str(e)}")
         return None
 
-def match_faces_to_students(face_encodings, class_name, school_id):
-    """Match detected faces to registered students"""
-    students = Student.query.filter_by(
+def process_class_photos(images, roster_size=None):
+    """Process several photos of one class concurrently and concatenate their faces"""
+    # Each photo of a multi-photo capture is expected to cover its share of the class
+    expected_faces = math.ceil(roster_size / len(images)) if roster_size else None
+    if len(images) == 1:
+        results = [process_class_photo(images[0], expected_faces)]
+    else:
+        # Threads only decode and wait; detection and encoding fan out across the face workers
+        with ThreadPoolExecutor(max_workers=len(images)) as executor:
+            results = list(executor.map(process_class_photo, images, [expected_faces] * len(images)))
+    if any(result is None for result in results):
+        return None
+
+    face_locations, face_encodings, photo_indexes, rejected_faces = [], [], [], []
+    for photo_index, result in enumerate(results):
+        face_locations.extend(result['face_locations'])
+        face_encodings.extend(result['face_encodings'])
+        photo_indexes.extend([photo_index] * len(result['face_locations']))
+        rejected_faces.extend(dict(face, photo_index=photo_index) for face in result['rejected_faces'])
+
+    return {
+        'face_locations': face_locations,
+        'face_encodings': face_encodings,
+        'photo_indexes': photo_indexes,
+        'rejected_faces': rejected_faces,
+        'detector_paths': [result['detector_path'] for result in results],
+        'total_faces': sum(result['total_faces'] for result in results),
+        'total_photos': len(images),
+        'image_sizes': [result['image_size'] for result in results],
+        # Photos answered from the photo cache ran no stages; a session of only those records none
+        'timings': {
+            stage: sum(result['timings'][stage] for result in results if stage in result['timings'])
+            if any(stage in result['timings'] for result in results) else None
+            for stage in ('decode_ms', 'detect_ms', 'encode_ms')
+        }
+    }
+
+def merge_photo_matches(matches, unmatched_faces, photo_indexes):
+    """Tag faces with their photo and keep only the closest face per student across photos"""
+    for face in matches + unmatched_faces:
+        face['photo_index'] = photo_indexes[face['face_index']]
+    if len(set(photo_indexes)) < 2:
+        return matches, unmatched_faces
+
+    best = {}
+    for match in matches:
+        kept = best.get(match['student_id'])
+        if kept is None or match['confidence'] > kept['confidence']:
+            best[match['student_id']] = match
+    merged = sorted(best.values(), key=lambda m: m['face_index'])
+    logger.debug(f"Merged {len(matches)} matches across photos into {len(merged)} students")
+    return merged, unmatched_faces
+
+FACE_ENCODING_DIM = 128
+FACE_ENCODING_BYTES = FACE_ENCODING_DIM * 4
+
+def encoding_to_bytes(face_encoding):
+    """Pack a 128-d face encoding into 512 bytes of float32"""
+    return np.asarray(face_encoding, dtype=np.float32).tobytes()
+
+def encoding_from_bytes(data):
+    """Read a packed face encoding without copying"""
+    return np.frombuffer(data, dtype=np.float32)
+
+def stored_encoding_bytes(face_encoding_bin, face_encoding):
+    """Packed encoding of a student row, falling back to the legacy JSON column"""
+    if face_encoding_bin is not None:
+        return bytes(face_encoding_bin) if len(face_encoding_bin) == FACE_ENCODING_BYTES else None
+    if not face_encoding:
+        return None
+    try:
+        encoding = json.loads(face_encoding)
+    except ValueError:
+        return None
+    if len(encoding) != FACE_ENCODING_DIM:
+        return None
+    return encoding_to_bytes(encoding)
+
+def load_class_gallery(class_name, school_id):
+    """Load the active roster of a class as one contiguous encoding matrix"""
+    rows = db.session.query(
+        Student.id, Student.name, Student.student_id, Student.face_encoding_bin, Student.face_encoding
+    ).filter_by(
         class_name=class_name,
         school_id=school_id,
         is_active=True
     ).all()
 
-    logger.info(f"[DEBUG] Number of students fetched for matching: {len(students)}")  # Added debug log
+    ids, names, student_ids, blobs, roster = [], [], [], [], []
+    for row in rows:
+        roster.append({'id': row.id, 'name': row.name, 'student_id': row.student_id})
+        blob = stored_encoding_bytes(row.face_encoding_bin, row.face_encoding)
+        if blob is None:
+            continue
+        ids.append(row.id)
+        names.append(row.name)
+        student_ids.append(row.student_id)
+        blobs.append(blob)
+
+    return {
+        'ids': ids,
+        'names': names,
+        'student_ids': student_ids,
+        'encodings': encoding_from_bytes(b''.join(blobs)).reshape(len(blobs), FACE_ENCODING_DIM),
+        'roster': roster
+    }
+
+# --- Class Gallery Cache ---
+# Galleries are cached per process and keyed by (school_id, class_name). Every roster
+# change bumps the class row in gallery_versions, so each worker notices the change
+# with one indexed lookup and reloads only the classes that actually changed.
+_gallery_cache = OrderedDict()
+_gallery_cache_bytes = 0
+_gallery_cache_lock = threading.Lock()
+# Striped by class, so the lock set stays fixed however many classes are seen
+_gallery_load_locks = [threading.Lock() for _ in range(64)]
+
+def get_gallery_version(school_id, class_name):
+    version = db.session.query(GalleryVersion.version).filter_by(
+        school_id=school_id, class_name=class_name
+    ).scalar()
+    return version or 0
+
+GALLERY_VERSION_UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+def bump_gallery_version(school_id, class_name):
+    """Mark a class roster as changed; call inside the transaction that changes it.
+
+    A single INSERT ... ON CONFLICT DO UPDATE, so two first changes to a new class
+    in concurrent transactions cannot both try to create its row.
+    """
+    now = datetime.utcnow()
+    dialect_insert = GALLERY_VERSION_UPSERT.get(db.engine.dialect.name)
+    if dialect_insert is None:
+        updated = GalleryVersion.query.filter_by(school_id=school_id, class_name=class_name).update(
+            {GalleryVersion.version: GalleryVersion.version + 1, GalleryVersion.updated_at: now},
+            synchronize_session=False
+        )
+        if not updated:
+            db.session.add(GalleryVersion(school_id=school_id, class_name=class_name, version=1))
+        return
+
+    statement = dialect_insert(GalleryVersion).values(
+        school_id=school_id, class_name=class_name, version=1, updated_at=now
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['school_id', 'class_name'],
+        set_={'version': GalleryVersion.version + 1, 'updated_at': now}
+    ))
+
+def _gallery_nbytes(gallery):
+    # Encoding matrix plus a rough allowance for the per-student Python objects
+    quantized = gallery.get('quantized')
+    if gallery.get('mapped'):
+        # The matrix lives in a shared gallery file and is paid for once, in the page cache
+        return 300 * len(gallery['roster'])
+    if quantized is None:
+        return gallery['encodings'].nbytes + 300 * len(gallery['roster'])
+    matrix = quantized['values'].nbytes + quantized['norms'].nbytes
+    if quantized['scales'] is not None:
+        matrix += quantized['scales'].nbytes
+    return matrix + 300 * len(gallery['roster'])
+
+def _gallery_cache_get(key, version):
+    with _gallery_cache_lock:
+        gallery = _gallery_cache.get(key)
+        if gallery is None or gallery['version'] != version:
+            return None
+        _gallery_cache.move_to_end(key)
+        return gallery
+
+def _gallery_cache_put(key, gallery):
+    global _gallery_cache_bytes
+    max_bytes = app.config.get('FACE_GALLERY_CACHE_MAX_BYTES', 128 * 1024 * 1024)
+    with _gallery_cache_lock:
+        previous = _gallery_cache.pop(key, None)
+        if previous is not None:
+            _gallery_cache_bytes -= previous['nbytes']
+        _gallery_cache[key] = gallery
+        _gallery_cache_bytes += gallery['nbytes']
+        while _gallery_cache_bytes > max_bytes and len(_gallery_cache) > 1:
+            _, evicted = _gallery_cache.popitem(last=False)
+            _gallery_cache_bytes -= evicted['nbytes']
+
+def invalidate_class_gallery(school_id, class_name):
+    global _gallery_cache_bytes
+    with _gallery_cache_lock:
+        evicted = _gallery_cache.pop((school_id, class_name), None)
+        if evicted is not None:
+            _gallery_cache_bytes -= evicted['nbytes']
+
+def get_class_gallery(class_name, school_id):
+    """Cached class gallery; concurrent misses for the same class share one load"""
+    key = (school_id, class_name)
+    version = get_gallery_version(school_id, class_name)
+    gallery = _gallery_cache_get(key, version)
+    if gallery is not None:
+        return gallery
+
+    with _gallery_cache_lock:
+        load_lock = _gallery_load_locks[hash(key) % len(_gallery_load_locks)]
+    with load_lock:
+        gallery = _gallery_cache_get(key, version)
+        if gallery is None:
+            gallery = load_mapped_class_gallery(class_name, school_id, version) or load_class_gallery(class_name, school_id)
+            mode = app.config.get('FACE_GALLERY_QUANTIZATION')
+            if mode and not gallery.get('mapped'):
+                gallery['quantized'] = quantize_encodings(gallery.pop('encodings'), mode)
+            gallery['version'] = version
+            gallery['nbytes'] = _gallery_nbytes(gallery)
+            _gallery_cache_put(key, gallery)
+            logger.info(f"Loaded gallery for {class_name} (school {school_id}, version {version}): {len(gallery['ids'])} encodings")
+    return gallery
+
+def update_cached_gallery_rows(school_id, class_name, version, centroids):
+    """Swap updated centroids into a cached gallery instead of reloading the class.
+
+    `version` is the gallery version the update was committed as; the cached copy is
+    patched only if it was exactly one version behind, otherwise it is dropped.
+    """
+    global _gallery_cache_bytes
+    key = (school_id, class_name)
+    with _gallery_cache_lock:
+        gallery = _gallery_cache.get(key)
+        if gallery is None:
+            return
+        if gallery['version'] != version - 1:
+            _gallery_cache.pop(key)
+            _gallery_cache_bytes -= gallery['nbytes']
+            return
+        rows = {student_id: row for row, student_id in enumerate(gallery['ids'])}
+        changed = [(rows[student_id], centroid) for student_id, centroid in centroids.items() if student_id in rows]
+        # Readers may hold the old dict, so publish a new one rather than mutating it
+        if gallery.get('quantized') is None:
+            encodings = gallery['encodings'].copy()
+            for row, centroid in changed:
+                encodings[row] = centroid
+            _gallery_cache[key] = dict(gallery, encodings=encodings, version=version)
+        else:
+            quantized = {name: (part.copy() if isinstance(part, np.ndarray) else part)
+                         for name, part in gallery['quantized'].items()}
+            if changed:
+                patch = quantize_encodings(np.asarray([c for _, c in changed]), quantized['mode'])
+                changed_rows = [row for row, _ in changed]
+                for name in ('values', 'scales', 'norms'):
+                    if quantized[name] is not None:
+                        quantized[name][changed_rows] = patch[name]
+            _gallery_cache[key] = dict(gallery, quantized=quantized, version=version)
+
+# --- Shared Gallery Files ---
+# `flask export-galleries` writes each school's encodings to one file in
+# FACE_GALLERY_DIR, and every process maps it read-only, so all workers share a
+# single copy through the page cache and start without querying the roster. Layout:
+# a fixed header (magic, stamp, index length, matrix offset), a JSON index of the
+# classes (gallery version, row range, ids, names, roster) and the float32 matrix
+# with each class in contiguous rows. The stamp is the sum of the school's class
+# versions, so it grows with every roster change. A pointer file names the current
+# file and is swapped with os.replace. Classes whose version moved past the file
+# are loaded from the database until the next export.
+GALLERY_FILE_MAGIC = b'SIHGAL01'
+GALLERY_FILE_HEADER = struct.Struct('<8sQQQ')  # magic, stamp, index length, matrix offset
+_mapped_galleries = {}
+_mapped_galleries_lock = threading.Lock()
+
+def gallery_pointer_path(school_id):
+    return os.path.join(app.config['FACE_GALLERY_DIR'], f"school-{school_id}.current")
+
+def export_school_gallery(school_id):
+    """Write a school's gallery file and point readers at it; returns the file path"""
+    gallery_dir = app.config['FACE_GALLERY_DIR']
+    os.makedirs(gallery_dir, exist_ok=True)
+
+    # Versions are read before the rows: a change committed in between leaves the file
+    # labelled with the older version, so readers fall back instead of trusting it
+    versions = dict(db.session.query(GalleryVersion.class_name, GalleryVersion.version).filter_by(school_id=school_id))
+    rows = db.session.query(
+        Student.id, Student.name, Student.student_id, Student.class_name, Student.face_encoding_bin, Student.face_encoding
+    ).filter_by(school_id=school_id, is_active=True).order_by(Student.class_name, Student.id).all()
+
+    classes, blobs = {}, []
+    for class_name in versions:
+        classes[class_name] = {'ids': [], 'names': [], 'student_ids': [], 'roster': []}
+    for row in rows:
+        entry = classes.setdefault(row.class_name, {'ids': [], 'names': [], 'student_ids': [], 'roster': []})
+        entry['roster'].append([row.id, row.name, row.student_id])
+        blob = stored_encoding_bytes(row.face_encoding_bin, row.face_encoding)
+        if blob is not None:
+            entry.setdefault('blobs', []).append(blob)
+            entry['ids'].append(row.id)
+            entry['names'].append(row.name)
+            entry['student_ids'].append(row.student_id)
+
+    start = 0
+    for class_name, entry in sorted(classes.items()):
+        class_blobs = entry.pop('blobs', [])
+        blobs.extend(class_blobs)
+        entry.update(version=versions.get(class_name, 0), start=start, end=start + len(class_blobs))
+        start += len(class_blobs)
+
+    stamp = sum(versions.values())
+    index = json.dumps({'school_id': school_id, 'stamp': stamp, 'dim': FACE_ENCODING_DIM, 'classes': classes}).encode()
+    matrix_offset = -(-(GALLERY_FILE_HEADER.size + len(index)) // 64) * 64
+
+    filename = f"school-{school_id}-{stamp}-{uuid.uuid4().hex[:8]}.gallery"
+    path = os.path.join(gallery_dir, filename)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(GALLERY_FILE_HEADER.pack(GALLERY_FILE_MAGIC, stamp, len(index), matrix_offset))
+        f.write(index)
+        f.write(b'\0' * (matrix_offset - GALLERY_FILE_HEADER.size - len(index)))
+        f.write(b''.join(blobs))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+    pointer = gallery_pointer_path(school_id)
+    previous = open(pointer).read().strip() if os.path.exists(pointer) else None
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(filename)
+    os.replace(pointer + '.tmp', pointer)
+
+    # Keep the previous file for processes that have not switched yet; mapped files
+    # stay readable after unlinking, so anything older can go
+    keep = {filename, previous}
+    for name in os.listdir(gallery_dir):
+        if name.startswith(f"school-{school_id}-") and name.endswith('.gallery') and name not in keep:
+            os.remove(os.path.join(gallery_dir, name))
+    return path
+
+def mapped_school_gallery(school_id, refresh=False):
+    """The mapped gallery file of a school, switching to a newer file when `refresh` is set"""
+    with _mapped_galleries_lock:
+        entry = _mapped_galleries.get(school_id)
+        if entry is not None and not refresh:
+            return entry
+
+        pointer = gallery_pointer_path(school_id)
+        if not os.path.exists(pointer):
+            return entry
+        with open(pointer) as f:
+            filename = f.read().strip()
+        if entry is not None and entry['filename'] == filename:
+            return entry
+
+        with open(os.path.join(app.config['FACE_GALLERY_DIR'], filename), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, stamp, index_length, matrix_offset = GALLERY_FILE_HEADER.unpack_from(mapped, 0)
+        if magic != GALLERY_FILE_MAGIC:
+            raise ValueError(f"{filename} is not a gallery file")
+        index = json.loads(mapped[GALLERY_FILE_HEADER.size:GALLERY_FILE_HEADER.size + index_length])
+        rows = (len(mapped) - matrix_offset) // FACE_ENCODING_BYTES
+        matrix = np.frombuffer(mapped, dtype=np.float32, count=rows * FACE_ENCODING_DIM, offset=matrix_offset)
+
+        entry = {
+            'filename': filename, 'stamp': stamp, 'classes': index['classes'],
+            'matrix': matrix.reshape(rows, FACE_ENCODING_DIM)
+        }
+        _mapped_galleries[school_id] = entry
+        logger.info(f"Mapped gallery file {filename} for school {school_id}: {rows} encodings")
+        return entry
+
+def mapped_class_entry(class_name, school_id, version):
+    """File entry and class index for a class at `version`, or (None, None) if no file has it"""
+    if not app.config.get('FACE_GALLERY_DIR'):
+        return None, None
+    try:
+        entry = mapped_school_gallery(school_id)
+        if entry is None or entry['classes'].get(class_name, {}).get('version') != version:
+            entry = mapped_school_gallery(school_id, refresh=True)
+    except Exception as e:
+        logger.error(f"Error mapping gallery file for school {school_id}: {str(e)}")
+        return None, None
+    if entry is None or entry['classes'].get(class_name, {}).get('version') != version:
+        return None, None
+    return entry, entry['classes'][class_name]
+
+def load_mapped_class_gallery(class_name, school_id, version):
+    """Class gallery backed by the shared file, when the file has this class at `version`"""
+    entry, index = mapped_class_entry(class_name, school_id, version)
+    if entry is None:
+        return None
+    return {
+        'ids': index['ids'], 'names': index['names'], 'student_ids': index['student_ids'],
+        'encodings': entry['matrix'][index['start']:index['end']],
+        'roster': [{'id': i, 'name': n, 'student_id': s} for i, n, s in index['roster']],
+        'mapped': True
+    }
+
+# --- Quantized Galleries ---
+# With FACE_GALLERY_QUANTIZATION set, cached class galleries hold float16 encodings
+# (half the memory) or int8 with one scale per student (a quarter). Faces are scored
+# on the quantized matrix, then the closest FACE_GALLERY_RERANK students per face
+# are re-scored on their exact float32 encodings from the database, so matching
+# decisions, which only involve the nearest students, come out the same.
+GALLERY_QUANTIZATION_MODES = ('float16', 'int8')
+
+def quantize_encodings(encodings, mode):
+    """Quantized copy of an encoding matrix, with the squared norms used for distances"""
+    if mode not in GALLERY_QUANTIZATION_MODES:
+        raise ValueError(f"FACE_GALLERY_QUANTIZATION must be one of {', '.join(GALLERY_QUANTIZATION_MODES)}")
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, FACE_ENCODING_DIM)
+    if mode == 'float16':
+        values, scales = encodings.astype(np.float16), None
+        restored = values.astype(np.float64)
+    else:
+        scales = np.abs(encodings).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        values = np.round(encodings / scales[:, None]).astype(np.int8)
+        restored = values * scales[:, None].astype(np.float64)
+        scales = scales.astype(np.float32)
+    return {'mode': mode, 'values': values, 'scales': scales, 'norms': np.einsum('ij,ij->i', restored, restored)}
+
+def quantized_face_distances(face_encodings, quantized):
+    """Distances from every face to every quantized encoding, scaling the dot products per student"""
+    faces = np.asarray(face_encodings, dtype=np.float64).reshape(-1, FACE_ENCODING_DIM)
+    if len(faces) == 0 or len(quantized['values']) == 0:
+        return np.empty((len(faces), len(quantized['values'])))
+
+    dots = faces @ quantized['values'].T.astype(np.float64)
+    if quantized['scales'] is not None:
+        dots *= quantized['scales']
+    squared = np.einsum('ij,ij->i', faces, faces)[:, None] + quantized['norms'][None, :] - 2.0 * dots
+    np.maximum(squared, 0.0, out=squared)
+    return np.sqrt(squared, out=squared)
+
+def gallery_face_distances(face_encodings, gallery):
+    """Face-to-student distances for a class gallery, exact for each face's nearest students"""
+    quantized = gallery.get('quantized')
+    if quantized is None:
+        return compute_face_distances(face_encodings, gallery['encodings'])
+
+    distances = quantized_face_distances(face_encodings, quantized)
+    rerank = min(app.config.get('FACE_GALLERY_RERANK', 5), distances.shape[1])
+    if rerank == 0 or distances.shape[0] == 0:
+        return distances
+
+    columns = np.unique(nearest_candidates(distances, rerank))
+    ids = [gallery['ids'][j] for j in columns]
+    rows = db.session.query(Student.id, Student.face_encoding_bin, Student.face_encoding).filter(Student.id.in_(ids))
+    exact = {row.id: stored_encoding_bytes(row.face_encoding_bin, row.face_encoding) for row in rows}
+    found = [(j, exact[i]) for j, i in zip(columns, ids) if exact.get(i) is not None]
+    if found:
+        exact_encodings = encoding_from_bytes(b''.join(blob for _, blob in found)).reshape(len(found), FACE_ENCODING_DIM)
+        distances[:, [j for j, _ in found]] = compute_face_distances(face_encodings, exact_encodings)
+    return distances
+
+def compute_face_distances(face_encodings, gallery_encodings):
+    """Euclidean distance between every face (F x 128) and every student (S x 128) in one pass"""
+    faces = np.asarray(face_encodings, dtype=np.float64).reshape(-1, FACE_ENCODING_DIM)
+    if len(faces) == 0 or len(gallery_encodings) == 0:
+        return np.empty((len(faces), len(gallery_encodings)))
+
+    # Accumulate in float64: near-identical faces would otherwise lose their distance to cancellation
+    gallery_encodings = np.asarray(gallery_encodings, dtype=np.float64)
+
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab, computed as a single matrix product
+    squared = (
+        np.einsum('ij,ij->i', faces, faces)[:, None]
+        + np.einsum('ij,ij->i', gallery_encodings, gallery_encodings)[None, :]
+        - 2.0 * faces @ gallery_encodings.T
+    )
+    np.maximum(squared, 0.0, out=squared)
+    return np.sqrt(squared, out=squared)
+
+# --- Face Templates ---
+# A student can have several face templates. Matching only ever sees their centroid,
+# kept in face_encoding_bin and updated incrementally as templates are added, so the
+# class gallery stays one row per student. Students with no template rows have just
+# their enrollment encoding; it becomes their first template when a second arrives.
+def add_face_template(student, face_encoding, source='capture', session_id=None):
+    """Add a template and move the student's centroid by the running-mean update.
+
+    Once FACE_TEMPLATES_MAX is reached the oldest capture template is replaced, so
+    the enrollment photo is always kept. Returns the new centroid, or None if this
+    session already gave the student a template.
+    """
+    templates = StudentFaceTemplate.query.filter_by(student_id=student.id).order_by(StudentFaceTemplate.id).all()
+    if session_id and any(t.session_id == session_id for t in templates):
+        return None
+
+    new = np.asarray(face_encoding, dtype=np.float64)
+    current = stored_encoding_bytes(student.face_encoding_bin, student.face_encoding)
+    if current is None:
+        centroid, templates = new, []
+    else:
+        centroid = encoding_from_bytes(current).astype(np.float64)
+        if not templates:
+            templates = [StudentFaceTemplate(student_id=student.id, encoding=current, source='enrollment')]
+            db.session.add(templates[0])
+
+    count = len(templates)
+    replaceable = [t for t in templates if t.source == 'capture']
+    if count >= app.config.get('FACE_TEMPLATES_MAX', 10) and replaceable:
+        oldest = replaceable[0]
+        centroid = centroid + (new - encoding_from_bytes(oldest.encoding)) / count
+        oldest.encoding, oldest.session_id, oldest.created_at = encoding_to_bytes(new), session_id, datetime.utcnow()
+    elif count >= app.config.get('FACE_TEMPLATES_MAX', 10):
+        return None
+    else:
+        centroid = centroid + (new - centroid) / (count + 1)
+        db.session.add(StudentFaceTemplate(
+            student_id=student.id, encoding=encoding_to_bytes(new), source=source, session_id=session_id
+        ))
+
+    student.face_encoding_bin = encoding_to_bytes(centroid)
+    student.face_encoding = None
+    return centroid.astype(np.float32)
+
+MATCH_ASSIGNMENT_MODES = ('greedy', 'optimal')
+
+def assign_faces(distances, tolerance, mode='greedy'):
+    """Pick a student column per face row; -1 where no student is within tolerance.
+
+    'greedy' takes each face's nearest student independently, so one student can be
+    picked for two faces. 'optimal' solves the linear sum assignment over the whole
+    matrix, which uses each student at most once and maximises the number of faces
+    matched under the tolerance before minimising the total distance.
+    """
+    assigned = np.full(distances.shape[0], -1, dtype=np.intp)
+    if distances.size == 0:
+        return assigned
+
+    if mode == 'optimal':
+        # Pairs over the tolerance get a cost no combination of valid pairs can reach
+        cost = np.where(distances < tolerance, distances, distances.shape[0] + 1.0)
+        rows, cols = linear_sum_assignment(cost)
+        valid = distances[rows, cols] < tolerance
+        assigned[rows[valid]] = cols[valid]
+    else:
+        best = np.argmin(distances, axis=1)
+        valid = distances[np.arange(len(best)), best] < tolerance
+        assigned[valid] = best[valid]
+    return assigned
+
+def nearest_candidates(distances, count):
+    """Column indices of the `count` nearest students for every face, nearest first"""
+    count = min(count, distances.shape[1])
+    if count == 0:
+        return np.empty((distances.shape[0], 0), dtype=np.intp)
+    nearest = np.argpartition(distances, count - 1, axis=1)[:, :count]
+    order = np.take_along_axis(distances, nearest, axis=1).argsort(axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+def match_faces_to_students(face_encodings, class_name, school_id, gallery=None, assignment=None):
+    """Match detected faces to registered students"""
+    if gallery is None:
+        gallery = get_class_gallery(class_name, school_id)
+
+    logger.info(f"[DEBUG] Number of students fetched for matching: {len(gallery['ids'])}")  # Added debug log
 
-    
     matches = []
     unmatched_faces = []
-    
+
     tolerance = app.config.get('FACE_RECOGNITION_TOLERANCE', 0.6)
+    assignment = assignment or app.config.get('FACE_MATCH_ASSIGNMENT', 'greedy')
 
-    logger.info(f"[DEBUG] Face recognition tolerance set to: {tolerance}")  # Added debug log
+    logger.info(f"[DEBUG] Face recognition tolerance set to: {tolerance}, assignment: {assignment}")  # Added debug log
 
-    for i, face_encoding in enumerate(face_encodings):
-        best_match = None
-        best_distance = float('inf')
-        
-        for student in students:
-            if not student.face_encoding:
-                continue
-            
-            try:
-                stored_encoding = np.array(json.loads(student.face_encoding))
-                distance = face_recognition.face_distance([stored_encoding], face_encoding)[0]
-                
-                if distance < tolerance and distance < best_distance:
-                    best_match = student
-                    best_distance = distance
-            except:
-                continue
-        
-        if best_match:
+    distances = gallery_face_distances(face_encodings, gallery)
+    assigned = assign_faces(distances, tolerance, assignment)
+    # One spare candidate so the assigned student can be dropped from the runner-up list
+    nearest = nearest_candidates(distances, app.config.get('FACE_MATCH_CANDIDATES', 3) + 1)
+
+    for i in range(distances.shape[0]):
+        best = int(assigned[i])
+        candidates = [
+            {
+                'student_id': gallery['ids'][j],
+                'student_name': gallery['names'][j],
+                'student_id_number': gallery['student_ids'][j],
+                'confidence': max(0.0, 1 - float(distances[i, j]))
+            }
+            for j in nearest[i] if j != best
+        ][:nearest.shape[1] - 1]
+
+        if best >= 0:
             matches.append({
                 'face_index': i,
-                'student_id': best_match.id,
-                'student_name': best_match.name,
-                'student_id_number': best_match.student_id,
-                'confidence': 1 - best_distance
+                'student_id': gallery['ids'][best],
+                'student_name': gallery['names'][best],
+                'student_id_number': gallery['student_ids'][best],
+                'confidence': 1 - float(distances[i, best]),
+                'candidates': candidates
             })
         else:
             unmatched_faces.append({
                 'face_index': i,
-                'confidence': 0
+                'confidence': 0,
+                'candidates': candidates
             })
             logger.info(f"[DEBUG] Face {i} unmatched.")  # Added debug log
 
     logger.info(f"[DEBUG] Total matches: {len(matches)}, unmatched faces: {len(unmatched_faces)}")  # Added debug log
     return matches, unmatched_faces
 
+# --- School Face Index ---
+# Every active encoding of a school in one IVF-style index: k-means partitions the
+# encodings into about sqrt(N) lists, and a lookup scores only the lists whose
+# centroids are nearest the query. The index tracks the gallery version of each
+# class, so a roster change reloads and re-assigns only that class; the partitions
+# are re-trained only once the school has doubled in size since the last training.
+_face_index_cache = OrderedDict()
+_face_index_lock = threading.Lock()
+_face_index_load_locks = {}
+_face_index_districts = {}  # district id -> school count, for districts searched as a whole
+
+def load_school_encodings(school_id, class_names=None):
+    """Active encodings of a school (or some of its classes), grouped by class, in one query"""
+    query = db.session.query(
+        Student.id, Student.name, Student.student_id, Student.class_name, Student.face_encoding_bin, Student.face_encoding
+    ).filter_by(school_id=school_id, is_active=True)
+    if class_names is not None:
+        query = query.filter(Student.class_name.in_(class_names))
+
+    rows_by_class = {}
+    for row in query:
+        blob = stored_encoding_bytes(row.face_encoding_bin, row.face_encoding)
+        if blob is not None:
+            rows_by_class.setdefault(row.class_name, []).append((row.id, row.name, row.student_id, blob))
+
+    blocks = {}
+    for class_name, rows in rows_by_class.items():
+        ids, names, student_ids, blobs = zip(*rows)
+        blocks[class_name] = {
+            'ids': list(ids), 'names': list(names), 'student_ids': list(student_ids),
+            'encodings': encoding_from_bytes(b''.join(blobs)).reshape(len(blobs), FACE_ENCODING_DIM)
+        }
+    return blocks
+
+def mapped_school_encodings(school_id, versions):
+    """Per-class blocks and the whole matrix of the shared gallery file, if it is current for every class"""
+    if not app.config.get('FACE_GALLERY_DIR'):
+        return None
+
+    def current(entry):
+        return entry is not None and all(entry['classes'].get(c, {}).get('version') == v for c, v in versions.items())
+
+    try:
+        entry = mapped_school_gallery(school_id)
+        if not current(entry):
+            entry = mapped_school_gallery(school_id, refresh=True)
+    except Exception as e:
+        logger.error(f"Error mapping gallery file for school {school_id}: {str(e)}")
+        return None
+    if not current(entry):
+        return None
+
+    blocks = {
+        class_name: {
+            'ids': index['ids'], 'names': index['names'], 'student_ids': index['student_ids'],
+            'encodings': entry['matrix'][index['start']:index['end']]
+        }
+        for class_name, index in entry['classes'].items() if index['ids']
+    }
+    return blocks, entry['matrix']
+
+def train_index_partitions(encodings, lists, iterations=10):
+    """Lloyd's k-means on a sample of the encodings; returns the list centroids"""
+    rng = np.random.default_rng(0)
+    sample = encodings[rng.choice(len(encodings), min(len(encodings), lists * 64), replace=False)].astype(np.float64)
+    centroids = sample[rng.choice(len(sample), lists, replace=False)]
+    for _ in range(iterations):
+        nearest = np.argmin(compute_face_distances(sample, centroids), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, sample)
+        counts = np.bincount(nearest, minlength=lists)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+def build_face_index(school_id, versions, previous=None):
+    """Build a school index at the given class versions, reusing what `previous` already holds"""
+    mapped = mapped_school_encodings(school_id, versions)
+    if mapped is not None:
+        # The file holds the classes in sorted order, so its matrix is the index matrix
+        blocks, file_matrix = mapped
+    elif previous is None:
+        blocks, file_matrix = load_school_encodings(school_id), None
+    else:
+        file_matrix = None
+        changed = [c for c, v in versions.items() if previous['class_versions'].get(c) != v]
+        blocks = {c: b for c, b in previous['blocks'].items() if c not in changed}
+        blocks.update(load_school_encodings(school_id, changed) if changed else {})
+
+    class_names = sorted(blocks)
+    total = sum(len(blocks[c]['ids']) for c in class_names)
+    centroids = previous['centroids'] if previous is not None else None
+    trained_size = previous['trained_size'] if previous is not None else 0
+    if total >= app.config.get('FACE_INDEX_MIN_TRAIN', 1024) and (centroids is None or total > 2 * trained_size):
+        all_encodings = np.concatenate([blocks[c]['encodings'] for c in class_names])
+        centroids = train_index_partitions(all_encodings, int(math.sqrt(total)))
+        trained_size = total
+        for block in blocks.values():
+            block.pop('lists', None)
+    elif total < app.config.get('FACE_INDEX_MIN_TRAIN', 1024):
+        centroids, trained_size = None, 0
+
+    for block in blocks.values():
+        if centroids is None:
+            block['lists'] = np.zeros(len(block['ids']), dtype=np.intp)
+        elif 'lists' not in block:
+            block['lists'] = np.argmin(compute_face_distances(block['encodings'], centroids), axis=1)
+
+    index = {
+        'school_id': school_id, 'class_versions': versions, 'blocks': blocks,
+        'centroids': centroids, 'trained_size': trained_size, 'class_names': class_names,
+        'ids': [i for c in class_names for i in blocks[c]['ids']],
+        'names': [n for c in class_names for n in blocks[c]['names']],
+        'student_ids': [s for c in class_names for s in blocks[c]['student_ids']],
+        'classes': np.concatenate([np.full(len(blocks[c]['ids']), k) for k, c in enumerate(class_names)]
+                                  or [np.empty(0, dtype=int)]),
+        'encodings': file_matrix if file_matrix is not None else np.concatenate(
+            [blocks[c]['encodings'] for c in class_names] or [np.empty((0, FACE_ENCODING_DIM), dtype=np.float32)]
+        )
+    }
+    lists = np.concatenate([blocks[c]['lists'] for c in class_names] or [np.empty(0, dtype=np.intp)])
+    order = np.argsort(lists, kind='stable')
+    bounds = np.searchsorted(lists[order], np.arange((len(centroids) if centroids is not None else 1) + 1))
+    index['inverted_lists'] = [order[bounds[k]:bounds[k + 1]] for k in range(len(bounds) - 1)]
+    return index
+
+def face_index_cache_limit():
+    """Schools kept: FACE_INDEX_CACHE_MAX_SCHOOLS, raised to hold every school of the districts in use"""
+    return max(app.config.get('FACE_INDEX_CACHE_MAX_SCHOOLS', 16), sum(_face_index_districts.values()))
+
+def get_school_face_index(school_id, versions=None):
+    """Cached school index, refreshed for the classes whose gallery version changed"""
+    if versions is None:
+        versions = dict(db.session.query(GalleryVersion.class_name, GalleryVersion.version).filter_by(school_id=school_id))
+    with _face_index_lock:
+        index = _face_index_cache.get(school_id)
+        load_lock = _face_index_load_locks.setdefault(school_id, threading.Lock())
+    if index is not None and index['class_versions'] == versions:
+        return index
+
+    with load_lock:
+        with _face_index_lock:
+            index = _face_index_cache.get(school_id)
+        if index is None or index['class_versions'] != versions:
+            index = build_face_index(school_id, versions, previous=index)
+            logger.info(f"Built face index for school {school_id}: {len(index['ids'])} encodings, "
+                        f"{len(index['inverted_lists'])} lists")
+        with _face_index_lock:
+            _face_index_cache[school_id] = index
+            _face_index_cache.move_to_end(school_id)
+            while len(_face_index_cache) > face_index_cache_limit():
+                _face_index_cache.popitem(last=False)
+    return index
+
+def search_face_index(index, face_encodings, exclude_class=None):
+    """Nearest indexed student (row, distance) for every face, or (-1, inf) when none qualifies"""
+    faces = np.asarray(face_encodings, dtype=np.float64).reshape(-1, FACE_ENCODING_DIM)
+    results = [(-1, math.inf)] * len(faces)
+    if len(faces) == 0 or len(index['ids']) == 0:
+        return results
+
+    if index['centroids'] is None:
+        probes = np.zeros((len(faces), 1), dtype=np.intp)
+    else:
+        nprobe = min(app.config.get('FACE_INDEX_NPROBE', 8), len(index['centroids']))
+        probes = nearest_candidates(compute_face_distances(faces, index['centroids']), nprobe)
+
+    excluded = index['class_names'].index(exclude_class) if exclude_class in index['class_names'] else -1
+    for i, face in enumerate(faces):
+        rows = np.concatenate([index['inverted_lists'][p] for p in probes[i]])
+        rows = rows[index['classes'][rows] != excluded]
+        if len(rows) == 0:
+            continue
+        distances = compute_face_distances(face, index['encodings'][rows])[0]
+        best = int(np.argmin(distances))
+        results[i] = (int(rows[best]), float(distances[best]))
+    return results
+
+def suggest_students_for_faces(face_encodings, school_id, class_name):
+    """Closest student outside the class for each face, searched across the school or district"""
+    tolerance = app.config.get('FACE_RECOGNITION_TOLERANCE', 0.6)
+    school_ids = [school_id]
+    versions = {school_id: None}
+    if app.config.get('FACE_INDEX_SCOPE', 'school') == 'district':
+        school = School.query.get(school_id)
+        if school:
+            school_ids = [s.id for s in School.query.filter_by(district_id=school.district_id)]
+            # Every school is searched on each lookup, so the cache must hold the whole district
+            with _face_index_lock:
+                _face_index_districts[school.district_id] = len(school_ids)
+            versions = {s: {} for s in school_ids}
+            for row in db.session.query(GalleryVersion).filter(GalleryVersion.school_id.in_(school_ids)):
+                versions[row.school_id][row.class_name] = row.version
+
+    suggestions = [None] * len(face_encodings)
+    for other_school_id in school_ids:
+        index = get_school_face_index(other_school_id, versions[other_school_id])
+        exclude_class = class_name if other_school_id == school_id else None
+        for i, (row, distance) in enumerate(search_face_index(index, face_encodings, exclude_class)):
+            if row < 0 or distance >= tolerance:
+                continue
+            if suggestions[i] is None or 1 - distance > suggestions[i]['confidence']:
+                suggestions[i] = {
+                    'student_id': index['ids'][row],
+                    'student_name': index['names'][row],
+                    'student_id_number': index['student_ids'][row],
+                    'class_name': index['class_names'][index['classes'][row]],
+                    'school_id': other_school_id,
+                    'confidence': 1 - distance
+                }
+    return suggestions
+
+def find_duplicate_faces(face_encodings, school_id):
+    """Look new enrollment encodings up in the school index before they are inserted.
+
+    Returns, per encoding, the enrolled student it nearly duplicates, or
+    {'position': j} when it duplicates the earlier accepted encoding j of the same
+    list, or None. Missing encodings (None) are skipped.
+    """
+    tolerance = app.config.get('FACE_DUPLICATE_TOLERANCE', 0.4)
+    positions = [i for i, e in enumerate(face_encodings) if e is not None]
+    conflicts = [None] * len(face_encodings)
+    if not positions:
+        return conflicts
+
+    encodings = np.asarray([face_encodings[i] for i in positions], dtype=np.float64)
+    index = get_school_face_index(school_id)
+    for position, (row, distance) in zip(positions, search_face_index(index, encodings)):
+        if row >= 0 and distance < tolerance:
+            conflicts[position] = {
+                'student_id': index['ids'][row],
+                'student_name': index['names'][row],
+                'student_id_number': index['student_ids'][row],
+                'class_name': index['class_names'][index['classes'][row]],
+                'confidence': 1 - distance
+            }
+
+    # The same child may also appear twice within one bulk enrollment
+    within = compute_face_distances(encodings, encodings)
+    accepted = []
+    for k, position in enumerate(positions):
+        if conflicts[position] is None:
+            earlier = [j for j in accepted if within[k, j] < tolerance]
+            if earlier:
+                conflicts[position] = {'position': positions[earlier[0]]}
+            else:
+                accepted.append(k)
+    return conflicts
+
 # --- API Routes ---
 
 # SMS Communication Routes
@@ -739,17 +2162,23 @@ def get_students_for_class(user, school_id, class_name):
 @require_school_access
 def add_student(user):
     try:
-        data = request.get_json()
-        required_fields = ['name', 'student_id', 'class_name', 'gender', 'guardian_name', 'guardian_phone', 'face_image']
-        if any(not data.get(field) for field in required_fields):
+        data, uploads = read_upload_request('face_image')
+        face_image = uploads[0] if uploads else data.get('face_image')
+        required_fields = ['name', 'student_id', 'class_name', 'gender', 'guardian_name', 'guardian_phone']
+        if any(not data.get(field) for field in required_fields) or not face_image:
             return jsonify({'error': 'Missing required fields'}), 400
         
         if Student.query.filter_by(student_id=data['student_id']).first():
             return jsonify({'error': 'Student ID already exists'}), 400
         
-        face_encoding = encode_face_from_base64(data['face_image'])
+        face_encoding = encode_face_from_base64(face_image)
         if face_encoding is None:
             return jsonify({'error': 'No face detected in image or invalid image format'}), 400
+
+        if not truthy(data.get('allow_duplicate_face')):
+            conflict = find_duplicate_faces([face_encoding], user.school_id)[0]
+            if conflict is not None:
+                return jsonify({'error': 'This face is already enrolled', 'conflicting_student': conflict}), 409
         
         student = Student(
             name=data['name'].strip(), student_id=data['student_id'].strip(),
@@ -759,11 +2188,13 @@ def add_student(user):
 
             guardian_name=data['guardian_name'].strip(), guardian_phone=data['guardian_phone'].strip(),
             health_notes=data.get('health_notes', '').strip(),
-            face_encoding=json.dumps(face_encoding.tolist())
+            face_encoding_bin=encoding_to_bytes(face_encoding)
         )
         
         db.session.add(student)
+        bump_gallery_version(student.school_id, student.class_name)
         db.session.commit()
+        invalidate_class_gallery(student.school_id, student.class_name)
         logger.info(f"Student {student.name} added by {user.name}")
         return jsonify({'message': 'Student added successfully', 'student_id': student.id}), 201
         
@@ -774,6 +2205,97 @@ def add_student(user):
 
 
 
+@app.route('/api/students/bulk', methods=['POST'])
+@require_role(['principal'])
+@require_school_access
+def bulk_add_students(user):
+    """Enroll many students in one request; records have the same fields as POST /api/students"""
+    try:
+        records = (request.get_json() or {}).get('students')
+        max_records = app.config.get('BULK_ENROLL_MAX_RECORDS', 200)
+        if not isinstance(records, list) or not records:
+            return jsonify({'error': 'students must be a non-empty list'}), 400
+        if len(records) > max_records:
+            return jsonify({'error': f"Up to {max_records} students can be enrolled at once"}), 400
+
+        required_fields = ['name', 'student_id', 'class_name', 'gender', 'guardian_name', 'guardian_phone', 'face_image']
+        errors, candidates = [], []
+        for index, record in enumerate(records):
+            if not isinstance(record, dict):
+                errors.append({'index': index, 'student_id': None, 'error': 'Each student must be an object'})
+                continue
+            # JSON clients may send numbers for IDs and phone numbers
+            record = {**record, **{
+                field: str(record[field]).strip() for field in required_fields + ['health_notes']
+                if field != 'face_image' and record.get(field) is not None
+            }}
+            if any(not record.get(field) for field in required_fields):
+                errors.append({'index': index, 'student_id': record.get('student_id'), 'error': 'Missing required fields'})
+                continue
+            candidates.append((index, record))
+
+        # One set-based lookup for IDs already enrolled, plus repeats inside the batch
+        requested_ids = {record['student_id'] for _, record in candidates}
+        existing_ids = {sid for (sid,) in db.session.query(Student.student_id).filter(Student.student_id.in_(requested_ids))}
+        seen_ids, unique = set(), []
+        for index, record in candidates:
+            student_id = record['student_id']
+            if student_id in existing_ids or student_id in seen_ids:
+                errors.append({'index': index, 'student_id': student_id, 'error': 'Student ID already exists'})
+                continue
+            seen_ids.add(student_id)
+            unique.append((index, record))
+
+        encodings = encode_faces_from_images([record['face_image'] for _, record in unique])
+        conflicts = find_duplicate_faces(
+            [None if truthy(record.get('allow_duplicate_face')) else e for (_, record), e in zip(unique, encodings)],
+            user.school_id
+        )
+
+        rows, created, classes = [], [], set()
+        for (index, record), face_encoding, conflict in zip(unique, encodings, conflicts):
+            student_id = record['student_id']
+            if face_encoding is None:
+                errors.append({'index': index, 'student_id': student_id,
+                               'error': 'No face detected in image or invalid image format'})
+                continue
+            if conflict is not None:
+                if 'position' in conflict:
+                    conflict = {'index': unique[conflict['position']][0],
+                                'student_id_number': unique[conflict['position']][1]['student_id']}
+                errors.append({'index': index, 'student_id': student_id,
+                               'error': 'This face is already enrolled', 'conflicting_student': conflict})
+                continue
+            rows.append({
+                'name': record['name'], 'student_id': student_id,
+                'class_name': record['class_name'], 'school_id': user.school_id,
+                'gender': record['gender'],
+                'guardian_name': record['guardian_name'], 'guardian_phone': record['guardian_phone'],
+                'health_notes': record.get('health_notes') or '',
+                'face_encoding_bin': encoding_to_bytes(face_encoding)
+            })
+            created.append({'index': index, 'student_id': student_id})
+            classes.add(record['class_name'])
+
+        if rows:
+            db.session.bulk_insert_mappings(Student, rows)
+            for class_name in classes:
+                bump_gallery_version(user.school_id, class_name)
+            db.session.commit()
+            for class_name in classes:
+                invalidate_class_gallery(user.school_id, class_name)
+
+        errors.sort(key=lambda error: error['index'])
+        logger.info(f"Bulk enrollment by {user.name}: {len(rows)} added, {len(errors)} rejected")
+        return jsonify({
+            'message': f"{len(rows)} students added successfully",
+            'created': created, 'errors': errors
+        }), 201 if rows else 400
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error adding students in bulk: {str(e)}")
+        return jsonify({'error': 'Failed to add students'}), 500
 
 @app.route('/api/students/class/<class_name>', methods=['GET'])
 @require_role(['teacher', 'principal', 'district'])
@@ -836,58 +2358,428 @@ def school_students_summary(user):
 
 
 # Attendance Routes
+_capture_executor = None
+_capture_executor_lock = threading.Lock()
+
+def get_capture_executor():
+    """Local job runner for asynchronous captures; PhotoUpload rows track each job"""
+    global _capture_executor
+    with _capture_executor_lock:
+        if _capture_executor is None:
+            _capture_executor = ThreadPoolExecutor(
+                max_workers=app.config.get('CAPTURE_JOB_WORKERS', 2), thread_name_prefix='capture-job'
+            )
+        return _capture_executor
+
+CAPTURE_ACTIVE_STATUSES = ('pending', 'processing')
+
+def capture_worker_id():
+    """host:pid of this web process, recorded on the captures it runs"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def capture_owner_gone(worker_id):
+    """True when worker_id names a process on this host that no longer exists"""
+    host, _, pid = (worker_id or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def fail_orphaned_capture_jobs():
+    """Fail pending or processing captures whose owning web process is gone.
+
+    Queued jobs and their images only live in the process that accepted them, so once
+    it exits (restart, recycled or killed worker) nothing will ever finish its rows.
+    Live processes refresh heartbeat_at on the rows they own, so a row is orphaned when
+    its heartbeat is older than CAPTURE_JOB_STALE_AFTER, or at once when its owner was a
+    process on this host that has exited. Captures running on other hosts are left alone.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config.get('CAPTURE_JOB_STALE_AFTER', 300))
+    last_seen = func.coalesce(PhotoUpload.heartbeat_at, PhotoUpload.created_at)
+    candidates = PhotoUpload.query.filter(
+        PhotoUpload.processing_status.in_(CAPTURE_ACTIVE_STATUSES),
+        db.or_(last_seen < cutoff, PhotoUpload.worker_id.like(f"{socket.gethostname()}:%"))
+    ).all()
+    orphaned = [
+        photo_upload for photo_upload in candidates
+        if (photo_upload.heartbeat_at or photo_upload.created_at) < cutoff or capture_owner_gone(photo_upload.worker_id)
+    ]
+    for photo_upload in orphaned:
+        photo_upload.processing_status = 'failed'
+        photo_upload.recognition_results = json.dumps({'error': 'Processing was interrupted by a server restart'})
+    db.session.commit()
+    if orphaned:
+        logger.warning(f"Marked {len(orphaned)} interrupted capture sessions as failed")
+    return len(orphaned)
+
+_capture_heartbeat_pid = None
+_capture_heartbeat_lock = threading.Lock()
+
+def start_capture_heartbeat():
+    """Start this process's capture heartbeat once; every forked web worker starts its own"""
+    global _capture_heartbeat_pid
+    with _capture_heartbeat_lock:
+        if _capture_heartbeat_pid == os.getpid():
+            return
+        _capture_heartbeat_pid = os.getpid()
+    threading.Thread(target=_capture_heartbeat_loop, name='capture-heartbeat', daemon=True).start()
+
+def _capture_heartbeat_loop():
+    """Keep this process's captures alive and sweep the ones other processes left behind"""
+    while True:
+        time.sleep(app.config.get('CAPTURE_JOB_HEARTBEAT', 30))
+        with app.app_context():
+            try:
+                PhotoUpload.query.filter(
+                    PhotoUpload.worker_id == capture_worker_id(),
+                    PhotoUpload.processing_status.in_(CAPTURE_ACTIVE_STATUSES)
+                ).update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+                fail_orphaned_capture_jobs()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Capture heartbeat failed: {str(e)}")
+
+@app.cli.command('fail-orphaned-captures')
+def fail_orphaned_captures():
+    """Mark captures whose web process went away as failed so clients stop polling them"""
+    click.echo(f"Marked {fail_orphaned_capture_jobs()} capture sessions as failed")
+
+def score_capture_session(photo_upload, gallery, face_encodings, face_boxes, detection, assignment=None, timings=None):
+    """Match the faces of a session against the class gallery and store the results on it.
+
+    When a `timings` dict is passed, the matching and commit durations are added to it.
+    """
+    class_name, school_id = photo_upload.class_name, photo_upload.school_id
+    started = time.perf_counter()
+    photo_indexes = face_boxes[:, 0].tolist()
+
+    # Assign each photo on its own: overlapping photos show the same children again,
+    # and merge_photo_matches then keeps the closest face per student
+    matches, unmatched = [], []
+    for photo_index in sorted(set(photo_indexes)):
+        face_indexes = [i for i, p in enumerate(photo_indexes) if p == photo_index]
+        photo_matches, photo_unmatched = match_faces_to_students(
+            [face_encodings[i] for i in face_indexes], class_name, school_id,
+            gallery=gallery, assignment=assignment
+        )
+        for face in photo_matches + photo_unmatched:
+            face['face_index'] = face_indexes[face['face_index']]
+            face['location'] = face_boxes[face['face_index'], 1:].tolist()
+        matches.extend(photo_matches)
+        unmatched.extend(photo_unmatched)
+    matches, unmatched = merge_photo_matches(matches, unmatched, photo_indexes)
+
+    if unmatched and app.config.get('FACE_INDEX_SUGGESTIONS', True):
+        suggestions = suggest_students_for_faces(
+            [face_encodings[face['face_index']] for face in unmatched], school_id, class_name
+        )
+        for face, suggestion in zip(unmatched, suggestions):
+            face['suggestion'] = suggestion
+
+    all_students = gallery['roster']
+    present_student_ids = {match['student_id'] for match in matches}
+    absent_students = [
+        {'id': s['id'], 'name': s['name'], 'student_id': s['student_id']}
+        for s in all_students if s['id'] not in present_student_ids
+    ]
+
+    results = {
+        'matches': matches, 'unmatched_faces': unmatched, 'absent_students': absent_students,
+        'total_students_in_class': len(all_students), **detection
+    }
+    photo_upload.recognition_results = json.dumps(results)
+    photo_upload.processing_status = 'completed'
+    matched = time.perf_counter()
+    db.session.commit()
+    if timings is not None:
+        timings['match_ms'] = (matched - started) * 1000
+        timings['commit_ms'] = (time.perf_counter() - matched) * 1000
+    return results
+
+def record_capture_timing(photo_upload, timings, processing_result):
+    """Store the stage durations of a completed capture; failures here never fail the capture"""
+    try:
+        height, width = max(processing_result['image_sizes'], key=lambda size: size[0] * size[1])
+        db.session.add(CaptureTiming(
+            photo_upload_id=photo_upload.id, school_id=photo_upload.school_id,
+            image_width=width, image_height=height, total_photos=processing_result['total_photos'],
+            face_count=processing_result['total_faces'],
+            detector_path=','.join(processing_result['detector_paths'])[:50],
+            **{stage: round(value, 3) if value is not None else None for stage, value in timings.items()}
+        ))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error recording capture timings: {str(e)}")
+
+def run_capture_session(photo_upload, images, assignment=None, queue_ms=None):
+    """Detect, encode and match the photos of a capture session and store the results on it"""
+    started = time.perf_counter()
+    gallery = get_class_gallery(photo_upload.class_name, photo_upload.school_id)
+    timings = {'gallery_ms': (time.perf_counter() - started) * 1000}
+    if queue_ms is not None:
+        timings['queue_ms'] = queue_ms
+
+    processing_result = process_class_photos(images, roster_size=len(gallery['roster']))
+    if not processing_result:
+        photo_upload.processing_status = 'failed'
+        photo_upload.recognition_results = json.dumps({'error': 'Failed to process image'})
+        db.session.commit()
+        return None
+
+    # Keep every face so the session can be re-matched later without the images
+    face_boxes = np.asarray([
+        (photo_index, *location)
+        for photo_index, location in zip(processing_result['photo_indexes'], processing_result['face_locations'])
+    ], dtype=np.int32).reshape(-1, 5)
+    photo_upload.face_encodings = b''.join(encoding_to_bytes(e) for e in processing_result['face_encodings'])
+    photo_upload.face_boxes = face_boxes.tobytes()
+    photo_upload.detected_faces_count = processing_result['total_faces']
+
+    detection = {
+        'total_faces_detected': processing_result['total_faces'], 'total_photos': processing_result['total_photos'],
+        'detector_paths': processing_result['detector_paths'], 'rejected_faces': processing_result['rejected_faces']
+    }
+    timings.update(processing_result['timings'])
+    results = score_capture_session(
+        photo_upload, gallery, processing_result['face_encodings'], face_boxes, detection, assignment, timings
+    )
+    timings['total_ms'] = (time.perf_counter() - started) * 1000
+    record_capture_timing(photo_upload, timings, processing_result)
+    return results
+
+def rematch_capture_session(photo_upload, gallery=None, assignment=None):
+    """Re-score the stored faces of a completed session against the current gallery"""
+    face_encodings = encoding_from_bytes(photo_upload.face_encodings or b'').reshape(-1, FACE_ENCODING_DIM)
+    face_boxes = np.frombuffer(photo_upload.face_boxes, dtype=np.int32).reshape(-1, 5)
+    previous = json.loads(photo_upload.recognition_results or '{}')
+    detection = {
+        key: previous.get(key, default) for key, default in (
+            ('total_faces_detected', len(face_boxes)), ('total_photos', 1),
+            ('detector_paths', []), ('rejected_faces', [])
+        )
+    }
+    if gallery is None:
+        gallery = get_class_gallery(photo_upload.class_name, photo_upload.school_id)
+    return score_capture_session(photo_upload, gallery, face_encodings, face_boxes, detection, assignment)
+
+def capture_response(session_id, results):
+    # Sessions stored by older versions lack some of these keys
+    matches = results.get('matches', [])
+    absent_students = results.get('absent_students', [])
+    return {
+        'session_id': session_id,
+        'total_students_in_class': results.get('total_students_in_class', len(matches) + len(absent_students)),
+        'faces_detected': results.get('total_faces_detected', 0), 'photos_processed': results.get('total_photos', 1),
+        'matches_found': len(matches), 'detector_paths': results.get('detector_paths', []),
+        'present_students': matches, 'absent_students': absent_students,
+        'unmatched_faces': results.get('unmatched_faces', []), 'rejected_faces': results.get('rejected_faces', [])
+    }
+
+def _run_capture_job(session_id, images, assignment):
+    with app.app_context():
+        photo_upload = PhotoUpload.query.filter_by(session_id=session_id).first()
+        if not photo_upload or photo_upload.processing_status != 'pending':
+            return  # failed as orphaned while it waited in the queue
+        try:
+            queue_ms = (datetime.utcnow() - photo_upload.created_at).total_seconds() * 1000
+            photo_upload.processing_status = 'processing'
+            photo_upload.heartbeat_at = datetime.utcnow()
+            db.session.commit()
+            run_capture_session(photo_upload, images, assignment, queue_ms=queue_ms)
+            logger.info(f"Capture job {session_id} finished with status {photo_upload.processing_status}")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Capture job {session_id} failed: {str(e)}")
+            photo_upload.processing_status = 'failed'
+            photo_upload.recognition_results = json.dumps({'error': 'Failed to process attendance'})
+            db.session.commit()
+
 @app.route('/api/attendance/capture', methods=['POST'])
 @require_role(['teacher', 'principal'])
 @require_school_access
 def capture_attendance(user):
     try:
-        data = request.get_json()
-        if not data.get('class_name') or not data.get('image_data'):
+        data, uploads = read_upload_request('images')
+        images = uploads or data.get('images') or ([data['image_data']] if data.get('image_data') else [])
+        if not data.get('class_name') or not images:
             return jsonify({'error': 'Class name and image data required'}), 400
+        if not isinstance(images, list) or len(images) > app.config.get('CAPTURE_MAX_IMAGES', 5):
+            return jsonify({'error': f"Up to {app.config.get('CAPTURE_MAX_IMAGES', 5)} images can be captured at once"}), 400
         
         class_name = data['class_name']
         if user.role == 'teacher' and not TeacherAssignment.query.filter_by(teacher_id=user.id, class_name=class_name).first():
             return jsonify({'error': 'You are not assigned to this class'}), 403
+
+        assignment = data.get('assignment')
+        if assignment and assignment not in MATCH_ASSIGNMENT_MODES:
+            return jsonify({'error': f"Assignment must be one of: {', '.join(MATCH_ASSIGNMENT_MODES)}"}), 400
         
         session_id = str(uuid.uuid4())
-        processing_result = process_class_photo(data['image_data'])
-        if not processing_result:
-            return jsonify({'error': 'Failed to process image'}), 400
-        
+        run_async = truthy(data.get('async'))
+        start_capture_heartbeat()
         photo_upload = PhotoUpload(
             session_id=session_id, uploaded_by=user.id, class_name=class_name,
-            school_id=user.school_id, processing_status='processing',
-            detected_faces_count=processing_result['total_faces']
+            school_id=user.school_id, processing_status='pending' if run_async else 'processing',
+            worker_id=capture_worker_id(), heartbeat_at=datetime.utcnow()
         )
         db.session.add(photo_upload)
         db.session.commit()
+
+        if run_async:
+            # Request streams close with the request, so the job gets its own copy of binary uploads
+            images = [image.read() if hasattr(image, 'read') else image for image in images]
+            get_capture_executor().submit(_run_capture_job, session_id, images, assignment)
+            return jsonify({'session_id': session_id, 'status': 'pending'}), 202
         
-        matches, unmatched = match_faces_to_students(
-            processing_result['face_encodings'], class_name, user.school_id
-        )
-        
-        results = {'matches': matches, 'unmatched_faces': unmatched, 'total_faces_detected': processing_result['total_faces']}
-        photo_upload.recognition_results = json.dumps(results)
-        photo_upload.processing_status = 'completed'
-        db.session.commit()
-        
-        all_students = Student.query.filter_by(class_name=class_name, school_id=user.school_id, is_active=True).all()
-        present_student_ids = {match['student_id'] for match in matches}
-        absent_students = [
-            {'id': s.id, 'name': s.name, 'student_id': s.student_id}
-            for s in all_students if s.id not in present_student_ids
-        ]
+        results = run_capture_session(photo_upload, images, assignment)
+        if results is None:
+            return jsonify({'error': 'Failed to process image'}), 400
         
-        return jsonify({
-            'session_id': session_id, 'total_students_in_class': len(all_students),
-            'faces_detected': processing_result['total_faces'], 'matches_found': len(matches),
-            'present_students': matches, 'absent_students': absent_students, 'unmatched_faces': unmatched
-        })
+        return jsonify(capture_response(session_id, results))
         
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error processing attendance: {str(e)}")
         return jsonify({'error': 'Failed to process attendance'}), 500
 
+@app.route('/api/attendance/sessions/<session_id>', methods=['GET'])
+@require_role(['teacher', 'principal', 'district'])
+def get_capture_session(user, session_id):
+    try:
+        photo_session = PhotoUpload.query.filter_by(session_id=session_id).first()
+        if not photo_session or (photo_session.school_id != user.school_id and user.role != 'district'):
+            return jsonify({'error': 'Invalid session or access denied'}), 404
+        if user.role == 'district' and photo_session.school.district_id != user.district_id:
+            return jsonify({'error': 'Invalid session or access denied'}), 404
+
+        response = {
+            'session_id': session_id, 'status': photo_session.processing_status,
+            'class_name': photo_session.class_name, 'created_at': photo_session.created_at.isoformat()
+        }
+        results = json.loads(photo_session.recognition_results) if photo_session.recognition_results else {}
+        if photo_session.processing_status == 'completed':
+            response.update(capture_response(session_id, results))
+        elif photo_session.processing_status == 'failed':
+            response['error'] = results.get('error', 'Failed to process attendance')
+
+        return jsonify(response)
+
+    except Exception as e:
+        logger.error(f"Error fetching capture session: {str(e)}")
+        return jsonify({'error': 'Failed to fetch capture session'}), 500
+
+CAPTURE_TIMING_STAGES = (
+    'queue_ms', 'gallery_ms', 'decode_ms', 'detect_ms', 'encode_ms', 'match_ms', 'commit_ms', 'total_ms'
+)
+
+@app.route('/api/attendance/timings', methods=['GET'])
+@require_role(['principal', 'district'])
+@require_school_access
+def capture_timing_summary(user):
+    """Percentiles of each capture stage per school and day over the last `days` days"""
+    try:
+        days = max(1, min(int(request.args.get('days', 7)), 90))
+        if user.role == 'district':
+            school_ids = [s.id for s in School.query.filter_by(district_id=user.district_id)]
+            if request.args.get('school_id'):
+                school_ids = [int(request.args['school_id'])]
+        else:
+            school_ids = [user.school_id]
+
+        start_date = datetime.utcnow().date() - timedelta(days=days - 1)
+        rows = db.session.query(
+            CaptureTiming.school_id, CaptureTiming.created_at, CaptureTiming.face_count,
+            CaptureTiming.image_width, CaptureTiming.image_height,
+            *[getattr(CaptureTiming, stage) for stage in CAPTURE_TIMING_STAGES]
+        ).filter(
+            CaptureTiming.school_id.in_(school_ids),
+            CaptureTiming.created_at >= datetime.combine(start_date, datetime.min.time())
+        ).all()
+
+        groups = {}
+        for row in rows:
+            groups.setdefault((row.school_id, row.created_at.date()), []).append(row)
+
+        summaries = []
+        for (school_id, day), group in sorted(groups.items()):
+            stages = {}
+            for stage in CAPTURE_TIMING_STAGES:
+                values = np.array([getattr(r, stage) for r in group if getattr(r, stage) is not None])
+                if len(values):
+                    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+                    stages[stage] = {
+                        'p50': round(float(p50), 1), 'p90': round(float(p90), 1),
+                        'p99': round(float(p99), 1), 'mean': round(float(values.mean()), 1)
+                    }
+            summaries.append({
+                'school_id': school_id, 'date': day.isoformat(), 'captures': len(group),
+                'mean_faces': round(sum(r.face_count or 0 for r in group) / len(group), 1),
+                'mean_megapixels': round(
+                    sum((r.image_width or 0) * (r.image_height or 0) for r in group) / len(group) / 1e6, 2
+                ),
+                'stages': stages
+            })
+
+        return jsonify({'days': days, 'stages': list(CAPTURE_TIMING_STAGES), 'summaries': summaries})
+
+    except ValueError:
+        return jsonify({'error': 'days and school_id must be integers'}), 400
+    except Exception as e:
+        logger.error(f"Error summarizing capture timings: {str(e)}")
+        return jsonify({'error': 'Failed to summarize capture timings'}), 500
+
+@app.route('/api/attendance/rematch', methods=['POST'])
+@require_role(['teacher', 'principal'])
+@require_school_access
+def rematch_attendance(user):
+    """Re-score past capture sessions (by session_ids, or a date and optional class) from their stored faces"""
+    try:
+        data = request.get_json() or {}
+        assignment = data.get('assignment')
+        if assignment and assignment not in MATCH_ASSIGNMENT_MODES:
+            return jsonify({'error': f"assignment must be one of {', '.join(MATCH_ASSIGNMENT_MODES)}"}), 400
+
+        query = PhotoUpload.query.filter_by(school_id=user.school_id, processing_status='completed')
+        if data.get('session_ids'):
+            query = query.filter(PhotoUpload.session_id.in_(data['session_ids']))
+        elif data.get('date'):
+            day = datetime.strptime(data['date'], '%Y-%m-%d')
+            query = query.filter(PhotoUpload.created_at >= day, PhotoUpload.created_at < day + timedelta(days=1))
+        else:
+            return jsonify({'error': 'session_ids or date required'}), 400
+        if data.get('class_name'):
+            query = query.filter_by(class_name=data['class_name'])
+        if user.role == 'teacher':
+            assigned = [a.class_name for a in TeacherAssignment.query.filter_by(teacher_id=user.id)]
+            query = query.filter(PhotoUpload.class_name.in_(assigned))
+
+        started = time.perf_counter()
+        sessions, skipped = [], []
+        for photo_session in query.order_by(PhotoUpload.created_at).all():
+            if photo_session.face_boxes is None:
+                skipped.append(photo_session.session_id)
+                continue
+            results = rematch_capture_session(photo_session, assignment=assignment)
+            sessions.append(capture_response(photo_session.session_id, results))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        logger.info(f"Re-matched {len(sessions)} sessions in {elapsed_ms:.1f} ms for {user.name}")
+        return jsonify({'sessions': sessions, 'skipped_sessions': skipped, 'elapsed_ms': round(elapsed_ms, 1)})
+
+    except ValueError:
+        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error re-matching attendance: {str(e)}")
+        return jsonify({'error': 'Failed to re-match attendance'}), 500
+
 @app.route('/api/attendance/confirm', methods=['POST'])
 @require_role(['teacher', 'principal'])
 def confirm_attendance(user):
@@ -922,12 +2814,26 @@ def confirm_attendance(user):
         ).delete(synchronize_session=False)
         db.session.commit()
 
+        # Confident matches from this session become extra face templates for the students
+        session_results = json.loads(photo_session.recognition_results or '{}')
+        session_matches = {m['student_id']: m for m in session_results.get('matches', [])}
+        session_encodings = encoding_from_bytes(photo_session.face_encodings or b'').reshape(-1, FACE_ENCODING_DIM)
+        min_confidence = app.config.get('FACE_TEMPLATE_MIN_CONFIDENCE', 0.6)
+        centroids = {}
+
         records_created = 0
         for conf in confirmations:
             student = Student.query.filter_by(student_id=conf.get('student_id')).first()
             if not student or student.school_id != school_id:
                 continue
 
+            match = session_matches.get(student.id)
+            if (conf.get('status', 'present') == 'present' and match and match['confidence'] >= min_confidence
+                    and match['face_index'] < len(session_encodings) and student.class_name == class_name):
+                centroid = add_face_template(student, session_encodings[match['face_index']], session_id=session_id)
+                if centroid is not None:
+                    centroids[student.id] = centroid
+
             record = AttendanceRecord(
                 student_id=student.id,
                 date=today,
@@ -940,7 +2846,12 @@ def confirm_attendance(user):
             db.session.add(record)
             records_created += 1
 
+        if centroids:
+            bump_gallery_version(school_id, class_name)
         db.session.commit()
+        if centroids:
+            update_cached_gallery_rows(school_id, class_name, get_gallery_version(school_id, class_name), centroids)
+            logger.info(f"Added face templates for {len(centroids)} students from session {session_id}")
         logger.info(f"Attendance confirmed for {records_created} students for {class_name} on {today} by {user.name}")
         return jsonify({'message': f'Attendance recorded for {records_created} students', 'records_created': records_created})
 
@@ -1079,18 +2990,40 @@ def class_range_report(user, class_name):
 def health_check():
     return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
 
+def clear_face_caches():
+    """Drop this process's cached galleries, school indexes, mapped gallery files and photo results"""
+    global _gallery_cache_bytes
+    with _gallery_cache_lock:
+        _gallery_cache.clear()
+        _gallery_cache_bytes = 0
+    with _face_index_lock:
+        _face_index_cache.clear()
+        _face_index_districts.clear()
+    with _mapped_galleries_lock:
+        _mapped_galleries.clear()
+    with _photo_cache_lock:
+        _photo_cache.clear()
+
 @app.route('/api/init-demo-data', methods=['POST'])
 def init_demo_data():
     try:
+        # Other workers may still cache galleries under the old versions, so the new
+        # rosters start above every version handed out so far
+        last_version = db.session.query(func.max(GalleryVersion.version)).scalar() or 0
+
         # Clear existing data to prevent conflicts
+        db.session.query(CaptureTiming).delete()
         db.session.query(AttendanceRecord).delete()
         db.session.query(PhotoUpload).delete()
         db.session.query(TeacherAssignment).delete()
+        db.session.query(StudentFaceTemplate).delete()
         db.session.query(Student).delete()
         db.session.query(SMSHistory).delete()
-        # Users have foreign key constraints from School, so delete School first
-        db.session.query(School).delete() 
+        db.session.query(GalleryVersion).delete()
+        # Schools and users reference each other, so unlink the principals first
+        db.session.query(School).update({School.principal_id: None})
         db.session.query(User).delete()
+        db.session.query(School).delete()
         db.session.query(District).delete()
         db.session.commit()
 
@@ -1124,8 +3057,11 @@ def init_demo_data():
         ]
 
         db.session.add_all(students)
+        for class_name in {student.class_name for student in students}:
+            db.session.add(GalleryVersion(school_id=school.id, class_name=class_name, version=last_version + 1))
         
         db.session.commit()
+        clear_face_caches()
         return jsonify({'message': 'Demo data initialized successfully. Use X-User-ID header with values 1 (teacher), 2 (principal), or 3 (district).'})
         
     except Exception as e:
@@ -1149,6 +3085,231 @@ def create_tables():
         db.create_all()
         logger.info("Database tables created")
 
+@app.cli.command('migrate-face-encodings')
+@click.option('--batch-size', default=500, show_default=True, help='Rows converted per transaction')
+def migrate_face_encodings(batch_size):
+    """Add the face storage tables and columns, then convert legacy JSON face encodings to binary"""
+    db.create_all()
+    for model, column in ((Student, 'face_encoding_bin'), (PhotoUpload, 'face_encodings'), (PhotoUpload, 'face_boxes'),
+                          (PhotoUpload, 'worker_id'), (PhotoUpload, 'heartbeat_at')):
+        columns = {c['name'] for c in inspect(db.engine).get_columns(model.__tablename__)}
+        if column not in columns:
+            column_type = model.__table__.c[column].type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {model.__tablename__} ADD COLUMN {column} {column_type}"))
+            logger.info(f"Added {model.__tablename__}.{column} column")
+
+    converted, skipped, last_id = 0, 0, 0
+    while True:
+        students = Student.query.filter(
+            Student.id > last_id,
+            Student.face_encoding.isnot(None)
+        ).order_by(Student.id).limit(batch_size).all()
+        if not students:
+            break
+
+        for student in students:
+            blob = stored_encoding_bytes(student.face_encoding_bin, student.face_encoding)
+            if blob is None:
+                skipped += 1
+                continue
+            student.face_encoding_bin = blob
+            student.face_encoding = None
+            converted += 1
+
+        last_id = students[-1].id
+        db.session.commit()
+        logger.info(f"Migrated face encodings up to student id {last_id}")
+
+    click.echo(f"Converted {converted} face encodings, skipped {skipped} unreadable rows")
+
+ENROLLMENT_ROSTER_FIELDS = ('name', 'student_id', 'class_name', 'gender', 'guardian_name', 'guardian_phone')
+ENROLLMENT_PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def read_enrollment_roster(roster_path):
+    """Yield roster records from a CSV, JSON (list or {students: [...]}) or JSON-lines file"""
+    extension = os.path.splitext(roster_path)[1].lower()
+    with open(roster_path, newline='', encoding='utf-8') as f:
+        if extension == '.csv':
+            yield from csv.DictReader(f)
+        elif extension == '.jsonl':
+            yield from (json.loads(line) for line in f if line.strip())
+        else:
+            data = json.load(f)
+            yield from (data.get('students', []) if isinstance(data, dict) else data)
+
+def normalize_roster_record(record):
+    """Roster record with every value as a stripped string (JSON rosters may hold numbers); None if not an object"""
+    if not isinstance(record, dict):
+        return None
+    return {field: str(value).strip() for field, value in record.items() if value is not None}
+
+def enrollment_photo_path(record, photo_dir, photo_index):
+    """Photo named by the roster's photo column, else the file named after the student ID or name"""
+    photo = (record.get('photo') or '').strip()
+    if photo:
+        return os.path.join(photo_dir, photo)
+    for key in (record.get('student_id'), record.get('name')):
+        filename = photo_index.get((key or '').strip().lower())
+        if filename:
+            return os.path.join(photo_dir, filename)
+    return None
+
+def load_import_checkpoint(checkpoint_path, roster_path):
+    if not os.path.exists(checkpoint_path):
+        return {'roster': os.path.abspath(roster_path), 'rows_done': 0, 'created': 0, 'errors': []}
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('roster') != os.path.abspath(roster_path):
+        raise click.ClickException(f"Checkpoint {checkpoint_path} belongs to another roster")
+    return checkpoint
+
+def save_import_checkpoint(checkpoint_path, checkpoint):
+    # Write then rename, so a crash mid-write never leaves a truncated checkpoint
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+def import_enrollment_batch(rows, school_id):
+    """Encode and insert one batch of (row number, record, photo path); returns per-row errors"""
+    errors, candidates = [], []
+    for row, record, path in rows:
+        if record is None:
+            errors.append({'row': row, 'student_id': None, 'error': 'Row is not a student record'})
+            continue
+        student_id = record.get('student_id', '')
+        if any(not record.get(field) for field in ENROLLMENT_ROSTER_FIELDS):
+            errors.append({'row': row, 'student_id': student_id, 'error': 'Missing required fields'})
+        elif path is None or not os.path.isfile(path):
+            errors.append({'row': row, 'student_id': student_id, 'error': 'Photo not found'})
+        else:
+            candidates.append((row, record, path))
+
+    requested_ids = {record['student_id'] for _, record, _ in candidates}
+    existing_ids = {sid for (sid,) in db.session.query(Student.student_id).filter(Student.student_id.in_(requested_ids))}
+    seen_ids, unique = set(), []
+    for row, record, path in candidates:
+        student_id = record['student_id']
+        if student_id in existing_ids or student_id in seen_ids:
+            errors.append({'row': row, 'student_id': student_id, 'error': 'Student ID already exists'})
+            continue
+        seen_ids.add(student_id)
+        unique.append((row, record, path))
+
+    with ExitStack() as stack:
+        encodings = encode_faces_from_images([stack.enter_context(open(path, 'rb')) for _, _, path in unique])
+    conflicts = find_duplicate_faces(
+        [None if truthy(record.get('allow_duplicate_face')) else e for (_, record, _), e in zip(unique, encodings)],
+        school_id
+    )
+
+    students, classes = [], set()
+    for (row, record, path), face_encoding, conflict in zip(unique, encodings, conflicts):
+        if face_encoding is None:
+            errors.append({'row': row, 'student_id': record['student_id'],
+                           'error': 'No face detected in image or invalid image format'})
+            continue
+        if conflict is not None:
+            if 'position' in conflict:
+                conflict = {'row': unique[conflict['position']][0],
+                            'student_id_number': unique[conflict['position']][1]['student_id']}
+            errors.append({'row': row, 'student_id': record['student_id'],
+                           'error': 'This face is already enrolled', 'conflicting_student': conflict})
+            continue
+        students.append({
+            'name': record['name'], 'student_id': record['student_id'],
+            'class_name': record['class_name'], 'school_id': school_id,
+            'gender': record['gender'],
+            'guardian_name': record['guardian_name'], 'guardian_phone': record['guardian_phone'],
+            'health_notes': record.get('health_notes', ''),
+            'face_encoding_bin': encoding_to_bytes(face_encoding)
+        })
+        classes.add(record['class_name'])
+
+    if students:
+        db.session.bulk_insert_mappings(Student, students)
+        for class_name in classes:
+            bump_gallery_version(school_id, class_name)
+    db.session.commit()
+    for class_name in classes:
+        invalidate_class_gallery(school_id, class_name)
+    return len(students), errors
+
+@app.cli.command('import-enrollments')
+@click.argument('photo_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('roster', type=click.Path(exists=True, dir_okay=False))
+@click.option('--school-id', type=int, required=True, help='School the students are enrolled in')
+@click.option('--batch-size', default=200, show_default=True, help='Students encoded and inserted per transaction')
+@click.option('--checkpoint', type=click.Path(dir_okay=False), help='Progress file; defaults to ROSTER.checkpoint.json')
+def import_enrollments(photo_dir, roster, school_id, batch_size, checkpoint):
+    """Enroll students from a roster file and a directory of their photos.
+
+    The roster has the POST /api/students fields and an optional photo column;
+    without it the photo is the file named after the student ID or name. Each
+    committed batch is recorded in the checkpoint, so a rerun resumes after it.
+    """
+    if not School.query.get(school_id):
+        raise click.ClickException(f"School {school_id} does not exist")
+
+    checkpoint_path = checkpoint or roster + '.checkpoint.json'
+    progress = load_import_checkpoint(checkpoint_path, roster)
+    if progress['rows_done']:
+        click.echo(f"Resuming after row {progress['rows_done']}")
+
+    photo_index = {}
+    for entry in os.scandir(photo_dir):
+        stem, extension = os.path.splitext(entry.name)
+        if entry.is_file() and extension.lower() in ENROLLMENT_PHOTO_EXTENSIONS:
+            photo_index.setdefault(stem.lower(), entry.name)
+
+    def flush(batch):
+        created, errors = import_enrollment_batch(batch, school_id)
+        progress['rows_done'] = batch[-1][0]
+        progress['created'] += created
+        progress['errors'].extend(errors)
+        save_import_checkpoint(checkpoint_path, progress)
+        logger.info(f"Imported roster up to row {progress['rows_done']}: {created} added, {len(errors)} rejected")
+
+    with ExitStack() as stack:
+        if not face_pool_reachable():
+            # No shared pool to borrow: run one for this import so photos encode on every core
+            stack.callback(reset_face_pool)
+            stack.callback(app.config.__setitem__, 'FACE_POOL_ADDRESS', app.config.get('FACE_POOL_ADDRESS'))
+            pool_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            app.config['FACE_POOL_ADDRESS'] = os.path.join(pool_dir, 'face-pool.sock')
+            reset_face_pool()
+            pool_process = start_face_pool_server()
+            stack.callback(pool_process.wait)
+            stack.callback(pool_process.terminate)
+            click.echo(f"Started a face worker pool of {face_pool_workers()} processes")
+
+        batch = []
+        for row, record in enumerate(read_enrollment_roster(roster), start=1):
+            if row <= progress['rows_done']:
+                continue
+            record = normalize_roster_record(record)
+            path = enrollment_photo_path(record, photo_dir, photo_index) if record is not None else None
+            batch.append((row, record, path))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+    click.echo(f"Imported {progress['created']} students, {len(progress['errors'])} rows rejected (see {checkpoint_path})")
+    if app.config.get('FACE_GALLERY_DIR'):
+        click.echo(f"Exported gallery file {export_school_gallery(school_id)}")
+
+@app.cli.command('export-galleries')
+@click.option('--school-id', type=int, help='Export one school instead of all of them')
+def export_galleries(school_id):
+    """Write the shared gallery files that workers map instead of loading rosters"""
+    if not app.config.get('FACE_GALLERY_DIR'):
+        raise click.ClickException("FACE_GALLERY_DIR is not configured")
+    school_ids = [school_id] if school_id else [s.id for s in School.query.order_by(School.id)]
+    for sid in school_ids:
+        click.echo(f"School {sid}: {export_school_gallery(sid)}")
+
 # ... your other routes above ...
 
 @app.route('/api/students/<int:student_id>', methods=['DELETE', 'OPTIONS'])
@@ -1170,7 +3331,9 @@ def delete_student(user, student_id):
         
         # Soft delete by setting is_active to False
         student.is_active = False
+        bump_gallery_version(student.school_id, student.class_name)
         db.session.commit()
+        invalidate_class_gallery(student.school_id, student.class_name)
         
         logger.info(f"Student {student.name} deleted by {user.name}")
         return jsonify({'message': 'Student deleted successfully'})
@@ -1245,4 +3408,8 @@ def get_student_weekly_attendance(user, student_id):
 if __name__ == '__main__':
     with app.app_context():
         create_tables()
+        fail_orphaned_capture_jobs()
+    # The reloader re-runs this module in a child process; the pool belongs to the parent
+    if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        start_face_pool_server()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file